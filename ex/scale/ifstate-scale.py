@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+'''
+Scale harness for ifstate running on hosts with many network namespaces.
+
+For each namespace count N a config with N namespaces is generated, each
+containing a veth pair with addresses and a route. The harness runs
+`ifstatecli apply`, `check` and `show` and samples the ifstate process
+while running:
+
+  - wall time
+  - peak number of open file descriptors
+  - peak RSS (from wait4 rusage)
+  - peak number of helper (child) processes
+  - peak number of threads
+
+A probe process additionally measures how opening NetNameSpace instances
+(get_netns_instances) and building the LinkRegistry scale with N.
+
+The harness is destructive: run it on a throwaway box or use --unshare
+to run it inside of a private network and mount namespace.
+
+Example:
+
+  ./ifstate-scale.py --unshare 10 100 1000 2000
+'''
+
+import argparse
+import ipaddress
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+PREFIX = 'ifs-scale-'
+SAMPLE_INTERVAL = 0.02
+
+
+def gen_config(count):
+    namespaces = {}
+    for i in range(count):
+        # a /30 transfer network per netns
+        net = ipaddress.ip_address('10.0.0.0') + i * 4
+        namespaces["{}{}".format(PREFIX, i)] = {
+            'interfaces': [
+                {
+                    'name': 'veth0',
+                    'addresses': ["{}/30".format(net + 1)],
+                    'link': {
+                        'kind': 'veth',
+                        'peer': 'veth1',
+                        'state': 'up',
+                    },
+                },
+                {
+                    'name': 'veth1',
+                    'addresses': ["{}/30".format(net + 2)],
+                    'link': {
+                        'kind': 'veth',
+                        'peer': 'veth0',
+                        'state': 'up',
+                    },
+                },
+            ],
+            'routing': {
+                'routes': [
+                    {
+                        'to': '192.0.2.0/24',
+                        'dev': 'veth0',
+                        'via': str(net + 2),
+                    },
+                ],
+            },
+        }
+
+    return {
+        'interfaces': [],
+        'namespaces': namespaces,
+    }
+
+
+def descendants(pid):
+    '''
+    Get the pids of all descendant processes of pid.
+    '''
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as fh:
+                # the comm field might contain whitespace
+                ppid = int(fh.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    result = []
+    pending = [pid]
+    while pending:
+        for child in children.get(pending.pop(), []):
+            result.append(child)
+            pending.append(child)
+
+    return result
+
+
+def sample(pid, stats):
+    try:
+        stats['fds'] = max(stats['fds'], len(os.listdir('/proc/{}/fd'.format(pid))))
+        with open('/proc/{}/status'.format(pid)) as fh:
+            for line in fh:
+                if line.startswith('Threads:'):
+                    stats['threads'] = max(stats['threads'], int(line.split()[1]))
+    except OSError:
+        # process has terminated
+        return
+
+    stats['helpers'] = max(stats['helpers'], len(descendants(pid)))
+
+
+def measure(cmd):
+    '''
+    Run cmd and return its resource usage.
+    '''
+    stats = {
+        'fds': 0,
+        'helpers': 0,
+        'threads': 0,
+    }
+
+    start = time.monotonic()
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+    while True:
+        (pid, status, rusage) = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        sample(proc.pid, stats)
+        time.sleep(SAMPLE_INTERVAL)
+    # prevent Popen from waiting for the already reaped child
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    stats['wall'] = time.monotonic() - start
+    stats['rss'] = rusage.ru_maxrss
+    stats['rc'] = proc.returncode
+
+    return stats
+
+
+def probe():
+    '''
+    Measure the libifstate netns components in this process and dump the
+    results as JSON on stdout.
+    '''
+    import resource
+    from libifstate.netns import NetNameSpace, LinkRegistry, get_netns_instances
+
+    def snapshot(phase, start):
+        results[phase] = {
+            'wall': time.monotonic() - start,
+            'fds': len(os.listdir('/proc/self/fd')),
+            'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'helpers': len(descendants(os.getpid())),
+        }
+
+    results = {}
+
+    start = time.monotonic()
+    instances = get_netns_instances()
+    snapshot('get_netns_instances', start)
+
+    start = time.monotonic()
+    registry = LinkRegistry([], NetNameSpace(None))
+    snapshot('LinkRegistry', start)
+
+    start = time.monotonic()
+    registry.inventory_unmanaged()
+    snapshot('LinkRegistry.inventory_unmanaged', start)
+
+    results['netns'] = len(instances)
+    results['links'] = len(registry.registry)
+
+    json.dump(results, sys.stdout)
+
+
+def cleanup():
+    netns_list = subprocess.run(['ip', 'netns', 'list'], capture_output=True, text=True).stdout
+    for line in netns_list.splitlines():
+        name = line.split()[0]
+        if name.startswith(PREFIX):
+            subprocess.run(['ip', 'netns', 'del', name])
+
+
+def print_row(label, stats):
+    print("{:40} {:>9.2f}s {:>7} fds {:>9} KiB {:>5} helpers {:>5} threads".format(
+        label, stats['wall'], stats['fds'], stats['rss'], stats['helpers'], stats.get('threads', 0)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ifstate namespace scale harness")
+    parser.add_argument("counts", type=int, nargs='+', help="namespace counts to measure")
+    parser.add_argument("--ifstatecli", type=str, default="ifstatecli", help="ifstatecli command")
+    parser.add_argument("--unshare", action="store_true",
+                        help="run inside of a private network and mount namespace")
+    parser.add_argument("--json", action="store_true", help="dump results as JSON")
+    parser.add_argument("--probe", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.probe:
+        probe()
+        return
+
+    if args.unshare and os.environ.get('IFSTATE_SCALE_UNSHARED') is None:
+        os.environ['IFSTATE_SCALE_UNSHARED'] = '1'
+        os.execvp('unshare', ['unshare', '--net', '--mount', '--propagation', 'private',
+                              sys.executable] + sys.argv)
+
+    if os.environ.get('IFSTATE_SCALE_UNSHARED') is not None:
+        # hide netns bind mounts and ifstate state files from the host
+        subprocess.run(['mount', '-t', 'tmpfs', 'ifstate-scale', '/run'], check=True)
+
+    results = {}
+    for count in args.counts:
+        cleanup()
+        results[count] = {}
+
+        with tempfile.NamedTemporaryFile('w', suffix='.yml') as config:
+            yaml.safe_dump(gen_config(count), config)
+            config.flush()
+
+            print("N = {}".format(count))
+            for action in ['apply', 'check', 'show']:
+                stats = measure([args.ifstatecli, '-q', '-c', config.name, action])
+                results[count][action] = stats
+                print_row("  ifstatecli {}".format(action), stats)
+
+            probe_out = subprocess.run([sys.executable, __file__, '--probe', str(count)],
+                                       capture_output=True, text=True, check=True).stdout
+            results[count]['probe'] = json.loads(probe_out)
+            for phase, stats in results[count]['probe'].items():
+                if isinstance(stats, dict):
+                    print_row("  {}".format(phase), stats)
+            print()
+
+    cleanup()
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -153,6 +153,9 @@ def main():
     # Parameters for the vrrp-fifo action
     action_parsers[Actions.VRRP_FIFO].add_argument(
         "fifo", type=str, help="named FIFO to read state changes from")
+    action_parsers[Actions.VRRP_FIFO].add_argument(
+        "--settle-delay", type=float, default=0.0,
+        help="seconds to wait for further state changes of a vrrp group/instance before applying the latest one")
 
     # Parameters for the vrrp-worker action
     action_parsers[Actions.VRRP_WORKER].add_argument(
@@ -212,7 +215,7 @@ def main():
                 exit(ex.exit_code())
         elif args.action == Actions.VRRP_FIFO:
             from ifstate.vrrp import vrrp_fifo
-            vrrp_fifo(args.fifo, ifs_config)
+            vrrp_fifo(args.fifo, ifs_config, ifslog, args.settle_delay)
         elif args.action == Actions.VRRP_WORKER:
             from ifstate.vrrp import vrrp_worker
             vrrp_worker(args.type, args.name, ifs_config)
@@ -1,32 +1,50 @@
 from libifstate.util import logger, IfStateLogging
 
 import atexit
-from copy import deepcopy
+import collections
+import json
 import logging
+import math
 import multiprocessing as mp
 import threading
 import os
+import queue
 import re
 from setproctitle import setproctitle
 import signal
-import subprocess
 import sys
+import time
+
+# workers are forked from the vrrp-fifo process to inherit the parsed config
+mp_fork = mp.get_context('fork')
+
+# number of transitions per group/instance kept for the latency stats
+VRRP_STATS_SAMPLES = 100
+
+# transition phases in order, timestamped using time.monotonic()
+VRRP_PHASES = ('enqueue', 'dequeue', 'received', 'registry', 'plan', 'links', 'done')
 
 class VrrpFifoProcess():
     '''
     Process for vrrp group/instance configuration.
     '''
-    def __init__(self, worker_args):
-        self.worker_args = worker_args
-        self.logger_extra = {'iface': f'{worker_args[-2]} "{worker_args[-1]}"'}
+    def __init__(self, vrrp_type, vrrp_name, vrrp_states):
+        self.vrrp_type = vrrp_type
+        self.vrrp_name = vrrp_name
+        self.vrrp_states = vrrp_states
+        self.logger_extra = {'iface': f'{vrrp_type} "{vrrp_name}"'}
         self.state_queue = mp.Queue()
         self.worker_proc = None
+        self.worker_conn = None
 
         worker_io = threading.Thread(target=self.dequeue)
         worker_io.start()
 
-    def vrrp_update(self, vrrp_state):
-        self.state_queue.put(vrrp_state)
+    def vrrp_update(self, vrrp_state, timestamps=None):
+        if vrrp_state is None:
+            self.state_queue.put(None)
+        else:
+            self.state_queue.put((vrrp_state, timestamps or {}))
 
     def dequeue(self):
         while True:
@@ -34,93 +52,308 @@ class VrrpFifoProcess():
 
             # Should we terminate?
             if state is None:
-                self.worker_proc.stdin.close()
-                self.worker_proc.wait()
+                self.worker_conn.send(None)
+                self.worker_conn.close()
+                self.worker_proc.join()
                 return
 
             # Restart ifstate vrrp-worker if not alive alive?
-            if self.worker_proc.poll() is not None:
+            if not self.worker_proc.is_alive():
                 logger.warning("worker died", extra=self.logger_extra)
-                self.start()
+                self.vrrp_states.restart(self)
 
-            logger.info(f'state => {state}', extra=self.logger_extra)
-            self.worker_proc.stdin.write(f'{state}\n')
-            self.worker_proc.stdin.flush()
+            (vrrp_state, timestamps) = state
+            timestamps['dequeue'] = time.monotonic()
+            logger.info(f'state => {vrrp_state}', extra=self.logger_extra)
+            self.worker_conn.send(state)
         logger.warning("dequeue terminated")
 
     def start(self):
-        logger.info("spawning worker", extra=self.logger_extra)
-        self.worker_proc = subprocess.Popen(self.worker_args, stdin=subprocess.PIPE, stderr=sys.stderr, text=True)
+        logger.info("forking worker", extra=self.logger_extra)
+        (worker_conn, self.worker_conn) = mp_fork.Pipe(duplex=False)
+        self.worker_proc = mp_fork.Process(
+            target=vrrp_worker_process,
+            args=(self.vrrp_type, self.vrrp_name, self.vrrp_states, worker_conn, self.worker_conn),
+            daemon=True)
+        self.worker_proc.start()
+        worker_conn.close()
+
+
+class VrrpStateReceiver():
+    '''
+    Receives the (state, timestamps) tuples of a vrrp group/instance in a
+    worker. Queued states are coalesced, only the latest pending state is
+    applied after it has settled for settle_delay seconds.
+    '''
+    def __init__(self, conn, settle_delay):
+        self.conn = conn
+        self.settle_delay = settle_delay
+        self.pending = None
+        self.closed = False
+        # state being applied
+        self.applying = None
+
+    def receive(self, timeout=0):
+        '''
+        Receive all queued states, waiting up to timeout seconds (forever
+        if None) for the first one. Returns True if a state was received.
+        '''
+        received = False
+        while not self.closed and self.conn.poll(timeout):
+            try:
+                state = self.conn.recv()
+            except EOFError:
+                state = None
+
+            # None terminates the worker
+            if state is None:
+                self.closed = True
+                break
+
+            if self.pending is not None:
+                logger.debug(f'state {self.pending[0]} superseded by {state[0]}')
+            self.pending = state
+            received = True
+            timeout = 0
+
+        return received
+
+    def preempt(self):
+        '''
+        Check if the state being applied should be preempted by a pending
+        one. keepalived might send the current state again (i.e. on reload),
+        a repeated state is dropped and does not preempt the apply.
+        '''
+        if self.receive() and self.pending[0] == self.applying:
+            logger.debug(f'state {self.applying} repeated while being applied')
+            self.pending = None
+
+        return self.pending is not None or self.closed
+
+    def __iter__(self):
+        while True:
+            if self.pending is None:
+                self.receive(None)
+
+            # wait until no further state change arrives within the delay
+            while self.settle_delay > 0 and self.receive(self.settle_delay):
+                pass
+
+            if self.closed:
+                return
+
+            (state, self.pending) = (self.pending, None)
+            self.applying = state[0]
+            yield state
+            self.applying = None
+
+
+class VrrpStats():
+    '''
+    Failover latency stats of the vrrp groups/instances, collected from
+    the timestamps of the transitions reported by the workers.
+    '''
+    def __init__(self, stats_file):
+        self.stats_file = stats_file
+        self.latencies = {}
+        self.last = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, vrrp_state, timestamps):
+        start = timestamps['enqueue']
+        phases = {phase: round((timestamps[phase] - start) * 1000, 3)
+                  for phase in VRRP_PHASES if phase in timestamps}
+
+        with self.lock:
+            self.last[key] = {
+                'state': vrrp_state,
+                'preempted': timestamps.get('preempted', False),
+                'phases_ms': phases,
+            }
+
+            # preempted transitions did not complete
+            if 'done' in phases:
+                self.latencies.setdefault(
+                    key, collections.deque(maxlen=VRRP_STATS_SAMPLES)).append(phases['done'])
+
+    @staticmethod
+    def percentile(samples, p):
+        # nearest-rank method
+        return samples[max(0, math.ceil(p / 100 * len(samples)) - 1)]
+
+    def summary(self):
+        result = {}
+        with self.lock:
+            for key, last in self.last.items():
+                name = '{} "{}"'.format(*key)
+                result[name] = {'last': last}
+                samples = sorted(self.latencies.get(key, []))
+                if samples:
+                    result[name].update({
+                        'samples': len(samples),
+                        'p50_ms': self.percentile(samples, 50),
+                        'p99_ms': self.percentile(samples, 99),
+                        'max_ms': samples[-1],
+                    })
+
+        return result
+
+    def write(self):
+        tmp_file = f"{self.stats_file}.tmp"
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as fh:
+                json.dump(self.summary(), fh, indent=2)
+            os.replace(tmp_file, self.stats_file)
+        except IOError as err:
+            logger.warning(f'failed to write stats file {self.stats_file}: {err}')
+
+    def dump(self, *argv):
+        for name, stats in sorted(self.summary().items()):
+            if 'samples' in stats:
+                logger.info('p50 {p50_ms}ms p99 {p99_ms}ms max {max_ms}ms ({samples} transitions)'.format(**stats),
+                            extra={'iface': name})
+            logger.info('last {} transition: {}'.format(
+                stats['last']['state'],
+                ' '.join(f'{phase}={ms}ms' for phase, ms in stats['last']['phases_ms'].items())),
+                extra={'iface': name})
 
 
 class VrrpStates():
     '''
     Tracks processes and states for vrrp groups/instances.
     '''
-    def __init__(self, ifs_config):
+    def __init__(self, ifs_config, ifslog, settle_delay):
         self.ifs_config = ifs_config
+        self.ifslog = ifslog
+        self.settle_delay = settle_delay
         self.processes = {}
         self.states = {}
         self.pid_file = f"/run/libifstate/vrrp/{os.getpid()}.pid"
-        self.cfg_file = f"/run/libifstate/vrrp/{os.getpid()}.cfg"
-        self.worker_args = (
-            sys.argv[0],
-            '-c', self.cfg_file,
-            'vrrp-worker')
-        if logger.level == logging.DEBUG:
-            self.worker_args.append('-v')
+        self.stats = VrrpStats(f"/run/libifstate/vrrp/{os.getpid()}.stats")
+
+        # dead workers are forked again by the main thread
+        self.restart_queue = queue.SimpleQueue()
+
+        # workers report the timestamps of their transitions
+        self.stats_queue = mp_fork.Queue()
+        stats_io = threading.Thread(target=self.collect_stats, daemon=True)
+        stats_io.start()
+
+    def collect_stats(self):
+        while True:
+            (key, vrrp_state, timestamps) = self.stats_queue.get()
+            self.stats.add(key, vrrp_state, timestamps)
+            self.stats.write()
+
+    def prefork(self):
+        '''
+        Fork a worker for each vrrp group/instance of the config in advance,
+        the first state change does not need to wait for a new worker.
+        '''
+        # the workers inherit the precompiled vrrp plans
+        self.ifs_config.ifs.compile_vrrp_plans()
+
+        for key in self.ifs_config.ifs.vrrp_keys():
+            if not key in self.processes:
+                self.processes[key] = VrrpFifoProcess(*key, self)
+                self.processes[key].start()
+
+    def restart(self, process):
+        '''
+        Called by a dequeue thread to restart its dead worker. Forking from
+        a thread could hand a lock held by another thread to the worker,
+        so the main thread is signaled to fork the worker. Blocks until
+        the worker has been forked.
+        '''
+        forked = threading.Event()
+        self.restart_queue.put((process, forked))
+        os.kill(os.getpid(), signal.SIGUSR2)
+        forked.wait()
+
+    def restart_workers(self, *argv):
+        '''
+        Fork the workers requested by restart() (SIGUSR2 handler).
+        '''
+        while True:
+            try:
+                (process, forked) = self.restart_queue.get_nowait()
+            except queue.Empty:
+                return
+
+            process.start()
+            forked.set()
 
     def update(self, vrrp_type, vrrp_name, vrrp_state):
         '''
-        Updates the state for a group/instance. A new VrrpFifoProcess is spawned on-demand
-        if a group/instance is called the first time.
+        Updates the state for a group/instance. A new VrrpFifoProcess is forked on-demand
+        if a group/instance is not known by the config.
         '''
+        timestamps = {'enqueue': time.monotonic()}
+
+        # keepalived writes upper case keywords, the keys of the preforked
+        # workers are built from the config using the lower case ones
+        vrrp_type = vrrp_type.lower()
+        vrrp_state = vrrp_state.lower()
+
         key = (vrrp_type, vrrp_name)
         if not key in self.processes:
-            worker_args = self.worker_args + key
-            self.processes[key] = VrrpFifoProcess(worker_args)
+            logger.info("not used by the config, forking worker on demand",
+                        extra={'iface': '{} "{}"'.format(*key)})
+            self.processes[key] = VrrpFifoProcess(*key, self)
             self.processes[key].start()
 
         self.states[key] = vrrp_state
-        self.processes[key].vrrp_update(vrrp_state)
+        self.processes[key].vrrp_update(vrrp_state, timestamps)
 
     def reconfigure(self, *argv):
         '''
-        Reconfigure all known groups/instances using their last known state by spawning
-        new worker Processes.
+        Reconfigure the groups/instances whose config has changed using their last
+        known state by forking new worker processes. Workers of unchanged
+        groups/instances keep running with the model they have been forked
+        with: their fingerprint covers all config sections used by their
+        vrrp plans. The keys are lower case (see update()).
         '''
 
-        # save new config to temp file
+        # parse the new config before forking the new workers
+        old_fingerprints = self.ifs_config.ifs.vrrp_fingerprints
         try:
-            self.ifs_config.load_config()
-            self.ifs_config.dump_config(self.cfg_file)
+            self.ifs_config.ifs = self.ifs_config.load_config()
         except Exception as ex:
             logger.error(f'failed to reload config: {ex}')
             return
+        new_fingerprints = self.ifs_config.ifs.vrrp_fingerprints
+
+        for key in list(self.processes.keys()):
+            if old_fingerprints.get(key) == new_fingerprints.get(key):
+                logger.debug("config unchanged", extra={'iface': '{} "{}"'.format(*key)})
+                continue
+
+            logger.info("config changed", extra={'iface': '{} "{}"'.format(*key)})
+            self.processes.pop(key).vrrp_update(None)
 
+        self.prefork()
         for key, state in self.states.items():
-            worker_args = self.worker_args + key
-            self.processes[key].vrrp_update(None)
-            self.processes[key] = VrrpFifoProcess(worker_args)
-            self.processes[key].start()
-            self.processes[key].vrrp_update(self.states[key])
+            if old_fingerprints.get(key) != new_fingerprints.get(key):
+                self.update(*key, state)
 
     def cleanup_run(self, *argv):
         """
         """
-        for file in [self.pid_file, self.cfg_file]:
+        for file in [self.pid_file, self.stats.stats_file]:
             try:
                 os.unlink(file)
             except OSError as ex:
                 if ex.errno != 2:
                     logger.warning(f"cannot cleanup {file}: {ex}")
 
-def vrrp_fifo(args_fifo, ifs_config):
-    vrrp_states = VrrpStates(ifs_config)
+def vrrp_fifo(args_fifo, ifs_config, ifslog, settle_delay=0.0):
+    vrrp_states = VrrpStates(ifs_config, ifslog, settle_delay)
 
     signal.signal(signal.SIGHUP, vrrp_states.reconfigure)
     signal.signal(signal.SIGPIPE, signal.SIG_IGN)
     signal.signal(signal.SIGTERM, vrrp_states.cleanup_run)
+    signal.signal(signal.SIGUSR1, vrrp_states.stats.dump)
+    signal.signal(signal.SIGUSR2, vrrp_states.restart_workers)
 
     try:
         os.makedirs("/run/libifstate/vrrp", exist_ok=True)
@@ -128,11 +361,11 @@ def vrrp_fifo(args_fifo, ifs_config):
         with open(vrrp_states.pid_file, "w", encoding="utf-8") as fh:
             fh.write(args_fifo)
         atexit.register(vrrp_states.cleanup_run)
-
-        ifs_config.dump_config(vrrp_states.cfg_file)
     except IOError as err:
         logger.exception(f'failed to write pid file {vrrp_states.pid_file}: {err}')
 
+    vrrp_states.prefork()
+
     try:
         status_pattern = re.compile(
             r'(group|instance) "([^"]+)" (unknown|fault|backup|master|stop)( \d+)?$', re.IGNORECASE)
@@ -153,14 +386,62 @@ def vrrp_fifo(args_fifo, ifs_config):
     finally:
         vrrp_states.cleanup_run()
 
+def vrrp_worker_process(vrrp_type, vrrp_name, vrrp_states, conn, parent_conn):
+    '''
+    Entry point of the workers forked by the vrrp-fifo process. The
+    states are received from the pipe until None is received.
+    '''
+    ifs = vrrp_states.ifs_config.ifs
+    vrrp_states.ifslog.after_fork()
+
+    # inherited sending end of the pipe
+    parent_conn.close()
+
+    # the signal handlers of the vrrp-fifo process do not apply
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR2, signal.SIG_IGN)
+
+    # netlink sockets must not be shared with the vrrp-fifo process
+    ifs.reopen_sockets()
+
+    # a running apply is preempted if a newer state is pending
+    states = VrrpStateReceiver(conn, vrrp_states.settle_delay)
+    ifs.vrrp_preempt = states.preempt
+
+    instance_title = "vrrp-{}-{}".format(vrrp_type, vrrp_name)
+    setproctitle("ifstate-{}".format(instance_title))
+
+    logger.info('worker is alive')
+    try:
+        for (vrrp_state, timestamps) in states:
+            timestamps['received'] = time.monotonic()
+
+            # the model and the link registry are reused for every state
+            # change, only the registry items of the plan's links are refreshed
+            ifs.refresh_vrrp_links(vrrp_type, vrrp_name, vrrp_state)
+            timestamps['registry'] = time.monotonic()
+
+            ifs.vrrp_timestamps = timestamps
+            ifs.apply(vrrp_type, vrrp_name, vrrp_state)
+            ifs.vrrp_timestamps = None
+
+            vrrp_states.stats_queue.put(((vrrp_type, vrrp_name), vrrp_state, timestamps))
+        logger.info('terminating')
+    finally:
+        vrrp_states.ifslog.quit()
+
 def vrrp_worker(vrrp_type, vrrp_name, ifs_config):
     instance_title = "vrrp-{}-{}".format(vrrp_type, vrrp_name)
     setproctitle("ifstate-{}".format(instance_title))
 
     logger.info('worker is alive')
     for state in sys.stdin:
-        vrrp_state = state.strip()
+        vrrp_state = state.strip().lower()
 
-        ifstate = deepcopy(ifs_config.ifs)
-        ifstate.apply(vrrp_type, vrrp_name, vrrp_state)
+        # the model and the link registry are reused for every state
+        # change, only the registry items of the plan's links are refreshed
+        ifs_config.ifs.refresh_vrrp_links(vrrp_type, vrrp_name, vrrp_state)
+        ifs_config.ifs.apply(vrrp_type, vrrp_name, vrrp_state)
     logger.info('terminating')
@@ -1,11 +1,15 @@
 from libifstate.exception import LinkDuplicate, NetnsUnknown
 from libifstate.link.base import ethtool_path, Link
 from libifstate.address import Addresses
+from libifstate.cshaper import CShaper
 from libifstate.fdb import FDB
 from libifstate.neighbour import Neighbours
 from libifstate.routing import Tables, Rules, RTLookups
 from libifstate.parser import Parser
+from libifstate.sysctl import Sysctl, SYSCTL_FAMILIES
 from libifstate.tc import TC
+from libifstate.template import InterfaceTemplate
+from libifstate.vrrp import VrrpPlan, VRRP_STATES, vrrp_fingerprints
 from libifstate.exception import netlinkerror_classes
 import bisect
 import os
@@ -34,11 +38,12 @@ except ModuleNotFoundError:
     # ignore missing plugin
     pass
 
-from libifstate.netns import NetNameSpace, prepare_netns, LinkRegistry, get_netns_instances
-from libifstate.util import logger, IfStateLogging, LinkDependency
+from libifstate.netns import NetNameSpace, prepare_netns, open_namespaces, reopen_namespaces, reset_netnsids, LinkRegistry, get_netns_instances
+from libifstate.util import logger, IfStateLogging, LinkDependency, netns_iproute
 from libifstate.exception import FeatureMissingError, LinkCircularLinked, LinkNoConfigFound, ParserValidationError
 from ipaddress import ip_network, ip_interface
 from jsonschema import validate, ValidationError, FormatChecker
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
 import os
 import pkgutil
@@ -46,10 +51,15 @@ import re
 import secrets
 import json
 import errno
+import itertools
 import logging
+import time
 
 __version__ = "2.0.0"
 
+# max. number of netns handled concurrently when removing orphan links
+CLEANUP_WORKERS = 16
+
 
 class IfState():
     def __init__(self):
@@ -57,6 +67,14 @@ class IfState():
 
         self.namespaces = None
         self.root_netns = NetNameSpace(None)
+        # optional callable to preempt a vrrp apply at stage boundaries
+        self.vrrp_preempt = None
+        # (type, name, state) => VrrpPlan
+        self.vrrp_plans = {}
+        # optional dict receiving the timestamps of the vrrp apply phases
+        self.vrrp_timestamps = None
+        # (type, name) => fingerprint of the vrrp config
+        self.vrrp_fingerprints = {}
         self.defaults = []
         self.ignore = {}
         self.features = {
@@ -78,15 +96,12 @@ class IfState():
                 # BPF: disable libbpf stderr output
                 libbpf.libbpf_set_print(0)
 
-    def update(self, ifstates, soft_schema):
-        # check config schema
-        schema = json.loads(pkgutil.get_data(
-            "libifstate", "../schema/{}/ifstate.conf.schema.json".format(__version__.split('.')[0])))
+    def _validate(self, schema, ifstates, soft_schema, prefix="$"):
         try:
             validate(ifstates, schema, format_checker=FormatChecker())
         except ValidationError as ex:
             if len(ex.path) > 0:
-                path = ["$"]
+                path = [prefix]
                 for i, p in enumerate(ex.absolute_path):
                     if type(p) == int:
                         path.append("[{}]".format(p))
@@ -102,6 +117,30 @@ class IfState():
             else:
                 raise ParserValidationError(detail)
 
+    def _validate_templates(self, schema, ifstates, soft_schema, prefix="$"):
+        templates = []
+        for i, template in enumerate(ifstates.get('interface_templates', [])):
+            template = InterfaceTemplate(template)
+
+            # validate the first and the last instance only, all other
+            # instances differ by their index values which are in between
+            # (index_attrs bounds, interface name length)
+            instances = [template.first()]
+            if len(template) > 1:
+                instances.append(template.last())
+            self._validate(schema, {'interfaces': instances}, soft_schema,
+                           "{}.interface_templates[{}]".format(prefix, i))
+            templates.append(template)
+
+        return templates
+
+    def update(self, ifstates, soft_schema):
+        # check config schema
+        schema = json.loads(pkgutil.get_data(
+            "libifstate", "../schema/{}/ifstate.conf.schema.json".format(__version__.split('.')[0])))
+        self._validate(schema, ifstates, soft_schema)
+        self.vrrp_fingerprints = vrrp_fingerprints(ifstates)
+
         # add interface defaults
         if 'defaults' in ifstates:
             self.defaults = ifstates['parameters']['defaults']
@@ -112,25 +151,37 @@ class IfState():
         for ip in self.ignore.get('ipaddr', []):
             self.ipaddr_ignore.add(ip_network(ip))
 
-        # save cshaper profiles
-        self.cshaper_profiles = ifstates['parameters']['cshaper']
+        # precompile cshaper profiles
+        self.cshaper = CShaper(ifstates['parameters']['cshaper'])
 
-        # build link registry over all named netns
+        # build link registry over the root netns and all configured netns
         self.link_registry = LinkRegistry(self.ignore.get('ifname', []), self.root_netns)
 
-        self._update(self.root_netns, ifstates)
         if 'namespaces' in ifstates:
             self.namespaces = {}
             self.new_namespaces = []
-            for netns_name, netns_ifstates in ifstates['namespaces'].items():
-                is_new = netns_name not in pyroute2.netns.listnetns()
-                self.namespaces[netns_name] = NetNameSpace(netns_name)
-                if is_new:
+            current_netns_list = pyroute2.netns.listnetns()
+            for netns_name in ifstates['namespaces'].keys():
+                if netns_name not in current_netns_list:
                     self.new_namespaces.append(netns_name)
-                    self.link_registry.inventory_netns(self.namespaces[netns_name])
-                self._update(self.namespaces[netns_name], netns_ifstates)
 
-    def _update(self, netns, ifstates):
+            # namespaces are created and dumped concurrently
+            for netns, links in open_namespaces(list(ifstates['namespaces'].keys())):
+                self.namespaces[netns.netns] = netns
+                self.link_registry.add_netns(netns, links)
+
+            # links of unmanaged namespaces are orphans
+            self.link_registry.inventory_unmanaged()
+
+        self._update(self.root_netns, ifstates,
+                     self._validate_templates(schema, ifstates, soft_schema))
+        if 'namespaces' in ifstates:
+            for netns_name, netns_ifstates in ifstates['namespaces'].items():
+                self._update(self.namespaces[netns_name], netns_ifstates,
+                             self._validate_templates(schema, netns_ifstates, soft_schema,
+                                                      "$.namespaces.{}".format(netns_name)))
+
+    def _update(self, netns, ifstates, templates=()):
         # parse network sysctl settings
         if 'sysctl' in ifstates:
             for proto in  ifstates['sysctl'].keys():
@@ -151,8 +202,9 @@ class IfState():
             for name, config in ifstates['bpf'].items():
                 netns.bpf_progs.add(name, config)
 
-        # add interfaces from config
-        for ifstate in ifstates['interfaces']:
+        # add interfaces from config, template instances are expanded
+        # lazily and the cshaper expansion pass appends the ifb links
+        for ifstate in self.cshaper.expand(netns, itertools.chain(*templates, ifstates['interfaces'])):
             name = ifstate['name']
             kind = ifstate['link']['kind']
             defaults = self.get_defaults(
@@ -218,67 +270,6 @@ class IfState():
             if 'sysctl' in ifstate:
                 netns.sysctl.add(name, ifstate['sysctl'])
 
-            if 'cshaper' in ifstate:
-                profile_name = ifstate['parameters']['cshaper'].get(
-                    'profile', 'default')
-                logger.debug('cshaper profile {} enabled'.format(profile_name),
-                             extra={'iface': name, 'netns': netns})
-                cshaper_profile = deepcopy(self.cshaper_profiles[profile_name])
-
-                # ingress
-                ifb_name = re.sub(
-                    cshaper_profile['ingress_ifname']['search'], cshaper_profile['ingress_ifname']['replace'], name)
-                logger.debug('cshaper ifb name {}'.format(ifb_name),
-                             extra={'iface': name, 'netns': netns})
-
-                ifb_state = {
-                    'name': ifb_name,
-                    'link': {
-                        'state': 'up',
-                        'kind': 'ifb',
-                    },
-                    'tc': {
-                        'qdisc': cshaper_profile['ingress_qdisc'],
-                    }
-                }
-                ifb_state['tc']['qdisc']['bandwidth'] = ifstate['parameters']['cshaper'].get(
-                    'ingress', 'unlimited')
-
-                if 'vrrp' in ifstate:
-                    ifb_state['vrrp'] = ifstate['vrrp']
-
-                ifstates['interfaces'].append(ifb_state)
-
-                # egress
-                if 'tc' in ifstate:
-                    logger.warning(
-                        'cshaper settings replaces tc settings', extra={'iface': name, 'netns': netns})
-
-                ifstate['tc'] = {
-                    'ingress': True,
-                    'qdisc': cshaper_profile['egress_qdisc'],
-                    'filter': [
-                        {
-                            'kind': 'matchall',
-                            'parent': 'ffff:',
-                            'action': [
-                                {
-                                    'kind': 'mirred',
-                                    'direction': 'egress',
-                                    'action': 'redirect',
-                                    'dev': ifb_name,
-                                }
-                            ]
-                        }
-
-                    ]
-                }
-
-                ifstate['tc']['qdisc']['bandwidth'] = ifstate['parameters']['cshaper'].get(
-                    'egress', 'unlimited')
-
-                del ifstate['parameters']['cshaper']
-
             if 'tc' in ifstate:
                 netns.tc[name] = TC(
                     netns, name, ifstate['tc'])
@@ -316,6 +307,82 @@ class IfState():
                 for rule in ifstates['routing']['rules']:
                     netns.rules.add(rule)
 
+    def get_namespaces(self):
+        '''
+        Get the root netns and all configured namespaces.
+        '''
+        if self.namespaces is None:
+            return [self.root_netns]
+
+        return [self.root_netns] + list(self.namespaces.values())
+
+    def get_netns(self, netns_name):
+        '''
+        Get the root netns (None) or a configured netns by name.
+        '''
+        if netns_name is None:
+            return self.root_netns
+
+        if self.namespaces is None:
+            return None
+
+        return self.namespaces.get(netns_name)
+
+    def reopen_sockets(self):
+        '''
+        Open new netlink sockets for all namespaces, required in forked
+        processes.
+        '''
+        reopen_namespaces(self.get_namespaces())
+
+    def vrrp_keys(self):
+        '''
+        Get the (type, name) tuples of all vrrp groups and instances used
+        by links, routes and rules of the config.
+        '''
+        keys = set()
+        for netns in self.get_namespaces():
+            for vrrp_type in ['group', 'instance']:
+                for vrrp_name in netns.vrrp[vrrp_type].keys():
+                    keys.add((vrrp_type, vrrp_name))
+
+            objs = []
+            if netns.tables is not None:
+                objs.extend(itertools.chain(*netns.tables.tables.values()))
+            if netns.rules is not None:
+                objs.extend(netns.rules.rules)
+            for obj in objs:
+                if '_vrrp' in obj:
+                    keys.add((obj['_vrrp']['type'], obj['_vrrp']['name']))
+
+        return sorted(keys)
+
+    def compile_vrrp_plans(self):
+        '''
+        Precompile the vrrp plans of all vrrp groups/instances and states.
+        '''
+        stages = self._stages(True)
+        for vrrp_type, vrrp_name in self.vrrp_keys():
+            for vrrp_state in VRRP_STATES:
+                self.vrrp_plans[(vrrp_type, vrrp_name, vrrp_state)] = VrrpPlan(
+                    self, stages, vrrp_type, vrrp_name, vrrp_state)
+
+    def get_vrrp_plan(self, do_apply, vrrp_type, vrrp_name, vrrp_state):
+        key = (vrrp_type, vrrp_name, vrrp_state)
+        if not key in self.vrrp_plans:
+            self.vrrp_plans[key] = VrrpPlan(
+                self, self._stages(do_apply), vrrp_type, vrrp_name, vrrp_state)
+
+        return self.vrrp_plans[key]
+
+    def refresh_vrrp_links(self, vrrp_type, vrrp_name, vrrp_state):
+        '''
+        Refresh the link registry items of the links of a vrrp plan. The
+        vrrp workers keep the link registry between the transitions.
+        '''
+        plan = self.get_vrrp_plan(True, vrrp_type, vrrp_name, vrrp_state)
+        self.link_registry.refresh_links(plan.links())
+
     def apply(self, vrrp_type=None, vrrp_name=None, vrrp_state=None):
         self._apply(True, vrrp_type, vrrp_name, vrrp_state)
 
@@ -330,20 +397,8 @@ class IfState():
             log_str += "[netns={}]".format(item.netns.netns)
 
         if item.attributes['kind'] != 'physical':
-            # remove virtual interface
+            # remove virtual interface (done by free_registry_items)
             logger.log_del(log_str)
-            if do_apply:
-                try:
-                    item.netns.ipr.link('set', index=item.attributes['index'], state='down')
-                    item.netns.ipr.link('del', index=item.attributes['index'])
-                except Exception as err:
-                    if not isinstance(err, netlinkerror_classes):
-                         raise
-                    # ignore if the link is already gone, this might happen
-                    # when removing veth link peers
-                    if err.code != errno.ENODEV:
-                        logger.warning('removing link {} failed: {}'.format(
-                            ifname, err.args[1]), extra={'netns': item.netns})
             return True
         else:
             # shutdown physical interfaces
@@ -361,6 +416,51 @@ class IfState():
                             ifname, err.args[1]), extra={'netns': item.netns})
             return False
 
+    def free_registry_items(self, do_apply, items):
+        '''
+        Remove orphan virtual links. The links of each netns are removed
+        by a worker thread using its own netlink socket.
+        '''
+        netns_items = {}
+        for item in items:
+            netns_items.setdefault(item.netns, []).append(item)
+
+        if do_apply:
+            with ThreadPoolExecutor(max_workers=min(len(netns_items), CLEANUP_WORKERS)) as executor:
+                futures = [executor.submit(self._del_registry_items, netns, netns_list)
+                           for netns, netns_list in netns_items.items()]
+
+                # propagate unexpected exceptions
+                for future in futures:
+                    future.result()
+
+        for item in items:
+            self.link_registry.remove_link(item)
+
+    def _del_registry_items(self, netns, items):
+        # removing a link implies the link state to be down, the netns
+        # is expected to exist and must not be recreated
+        with netns_iproute(netns.netns, create=False) as ipr:
+            deleted = set()
+            for item in items:
+                # veth peers are removed together with their peer link
+                if item.index in deleted:
+                    continue
+
+                try:
+                    ipr.link('del', index=item.index)
+                    deleted.add(item.index)
+                    if item.attributes['kind'] == 'veth' and item.peer_netnsid is None:
+                        deleted.add(item.peer_index)
+                except Exception as err:
+                    if not isinstance(err, netlinkerror_classes):
+                         raise
+                    # ignore if the link is already gone, this might happen
+                    # when removing veth link peers in other namespaces
+                    if err.code != errno.ENODEV:
+                        logger.warning('removing link {} failed: {}'.format(
+                            item.attributes['ifname'], err.args[1]), extra={'netns': netns})
+
     def _dependencies(self, netns):
         deps = {}
         for ifname, link in netns.links.items():
@@ -448,9 +548,21 @@ class IfState():
             vrrp_type = vrrp_type.lower()
             vrrp_state = vrrp_state.lower()
 
+        # the nsids, tc, neighbour and address state might have been changed since the last run
+        reset_netnsids()
+        for netns in self.get_namespaces():
+            netns.reset_dumps()
+
+        if by_vrrp:
+            plan = self.get_vrrp_plan(do_apply, vrrp_type, vrrp_name, vrrp_state)
+            self._vrrp_timestamp('plan')
+            self._apply_vrrp_plan(do_apply, plan)
+            return
+
         # create and destroy namespaces to match config
+        removed_netns = []
         if not by_vrrp and self.namespaces is not None:
-            prepare_netns(do_apply, self.namespaces.keys(), self.new_namespaces)
+            removed_netns = prepare_netns(do_apply, self.namespaces.keys(), self.new_namespaces)
             logger.info("")
 
         # get link dependency tree
@@ -460,7 +572,13 @@ class IfState():
         if not by_vrrp:
             had_cleanup = False
             cleanup_items = []
+            removed_items = []
             for item in self.link_registry.registry:
+                # the links of removed namespaces are gone with them
+                if item.netns.netns in removed_netns:
+                    removed_items.append(item)
+                    continue
+
                 ifname = item.attributes['ifname']
                 # items without a link are orphan - keep them if they match the ignore regex list...
                 if item.link is None and not any(re.match(regex, ifname) for regex in self.ignore.get('ifname', [])):
@@ -475,8 +593,10 @@ class IfState():
                             item.attributes['orphan'] = True
 
             if cleanup_items:
-                for item in cleanup_items:
-                    self.link_registry.registry.remove(item)
+                self.free_registry_items(do_apply, cleanup_items)
+
+            for item in removed_items:
+                self.link_registry.remove_link(item)
 
             if had_cleanup:
                 logger.info("")
@@ -515,6 +635,16 @@ class IfState():
                     else:
                         self._apply_iface(do_apply, self.namespaces[link_dep.netns], link_dep, by_vrrp, vrrp_type, vrrp_name, vrrp_state)
 
+        # apply filters of shared tc blocks, after the links have been bound to them
+        if not by_vrrp:
+            for netns in self.get_namespaces():
+                for block in netns.tc_blocks.values():
+                    if netns.netns is None:
+                        logger.info(" {}".format(block.iface))
+                    else:
+                        logger.info(" {}[netns={}]".format(block.iface, netns.netns))
+                    block.apply(do_apply)
+
         # configure routing
         logger.info("")
         logger.info("configure routing...")
@@ -523,6 +653,51 @@ class IfState():
             for name, netns in self.namespaces.items():
                 self._apply_routing(do_apply, netns, by_vrrp, vrrp_type, vrrp_name, vrrp_state)
 
+    def _apply_vrrp_plan(self, do_apply, plan):
+        '''
+        Apply a precompiled vrrp plan: only the links, routes and rules of
+        the vrrp group/instance are reconciled.
+        '''
+        vrrp_args = (True, plan.vrrp_type, plan.vrrp_name, plan.vrrp_state)
+
+        logger.info("configure interfaces...")
+        for stage in plan.stages:
+            if self._vrrp_preempted():
+                return
+
+            for netns, link_dep in stage:
+                self._apply_iface(do_apply, netns, link_dep, *vrrp_args)
+        self._vrrp_timestamp('links')
+
+        if self._vrrp_preempted():
+            return
+
+        logger.info("")
+        logger.info("configure routing...")
+        for netns, routes in plan.routes:
+            netns.tables.apply_vrrp(routes, do_apply)
+        for netns, rules in plan.rules:
+            netns.rules.apply_vrrp(rules, do_apply)
+        self._vrrp_timestamp('done')
+
+    def _vrrp_timestamp(self, phase):
+        if self.vrrp_timestamps is not None:
+            self.vrrp_timestamps[phase] = time.monotonic()
+
+    def _vrrp_preempted(self):
+        '''
+        Test if a vrrp apply should be aborted since a newer vrrp state is
+        pending, which will reconcile all vrrp objects anyway.
+        '''
+        if self.vrrp_preempt is not None and self.vrrp_preempt():
+            if self.vrrp_timestamps is not None:
+                self.vrrp_timestamps['preempted'] = True
+            logger.info("")
+            logger.info("preempted by a pending vrrp state update")
+            return True
+
+        return False
+
     def _apply_bpf(self, do_apply, netns, had_bpf=False):
         if not netns.bpf_progs is None:
             if not had_bpf:
@@ -533,23 +708,33 @@ class IfState():
         return had_bpf
 
     def _apply_sysctl(self, do_apply, netns, had_sysctl=False):
+        # compare the settings against a single snapshot
+        netns.sysctl.take_snapshot()
+
+        changed = False
         for iface in ['all', 'default']:
             if netns.sysctl.has_settings(iface):
                 if not had_sysctl:
                     logger.info("configure sysctl settings...")
                     had_sysctl = True
-                netns.sysctl.apply(iface, do_apply)
+                changed |= netns.sysctl.apply(iface, do_apply)
 
         if netns.sysctl.has_globals():
             if not had_sysctl:
                 logger.info("configure sysctl settings...")
                 had_sysctl = True
-            netns.sysctl.apply_globals(do_apply)
+            changed |= len(netns.sysctl.apply_globals(do_apply)) > 0
+
+        # writing all/ or global settings (i.e. all/forwarding, ipv4/ip_forward)
+        # propagates to the interface settings, renew the stale snapshot
+        if do_apply and changed:
+            netns.sysctl.take_snapshot()
 
         return had_sysctl
 
     def _apply_iface(self, do_apply, netns, link_dep, by_vrrp, vrrp_type, vrrp_name, vrrp_state):
         ifname = link_dep.ifname
+        overrides = None
         if ifname in netns.links:
             link = netns.links[ifname]
 
@@ -571,7 +756,7 @@ class IfState():
                     if ifname in netns.links:
                         logger.debug('disabled due to vrrp constraint',
                                     extra={'iface': ifname})
-                        link.settings['state'] = 'down'
+                        overrides = {'state': 'down'}
         # ignore if this link is not vrrp aware at all
         elif by_vrrp:
             logger.debug('no vrrp setting',
@@ -581,7 +766,7 @@ class IfState():
         logger.info(" {}".format(link_dep))
 
         if ifname in netns.links:
-            excpts = link.apply(do_apply, netns.sysctl)
+            excpts = link.apply(do_apply, netns.sysctl, overrides)
             if excpts.has_errno(errno.EEXIST):
                 retry = True
 
@@ -621,19 +806,36 @@ class IfState():
         for ip in Parser._default_ifstates['parameters']['ignore']['ipaddr_builtin']:
             ipaddr_ignore.append(ip_network(ip))
 
-        root_config = self._show_netns(self.root_netns, showall, ipaddr_ignore)
+        # per interface sysctl settings known by the schema
+        if self.features['sysctl']:
+            schema = json.loads(pkgutil.get_data(
+                "libifstate", "../schema/{}/ifstate.conf.schema.json".format(__version__.split('.')[0])))
+            sysctl_keys = {
+                family: set(schema['$defs']['iface-sysctl-{}'.format(family)]['properties'].keys())
+                for family in SYSCTL_FAMILIES
+            }
+        else:
+            sysctl_keys = None
+
+        root_config = self._show_netns(self.root_netns, showall, ipaddr_ignore, sysctl_keys)
         netns_instances = get_netns_instances()
         if len(netns_instances) > 0:
             netns_configs = {}
             for netns in netns_instances:
-                netns_configs[netns.netns] = self._show_netns(netns, showall, ipaddr_ignore)
+                netns_configs[netns.netns] = self._show_netns(netns, showall, ipaddr_ignore, sysctl_keys)
 
             return {**defaults, **root_config, 'namespaces': netns_configs}
 
 
         return {**defaults, **root_config}
 
-    def _show_netns(self, netns, showall, ipaddr_ignore):
+    def _show_netns(self, netns, showall, ipaddr_ignore, sysctl_keys):
+        if sysctl_keys is not None:
+            # read the sysctl settings of all interfaces at once
+            sysctl_snapshot = netns.sysctl.snapshot(keys=sysctl_keys)
+        else:
+            sysctl_snapshot = {}
+
         ifs_links = []
         for ipr_link in netns.ipr.get_links():
             name = ipr_link.get_attr('IFLA_IFNAME')
@@ -715,6 +917,11 @@ class IfState():
 
                 brport.BRPort.show(netns.ipr, showall, ipr_link['index'], ifs_link)
 
+                if name != 'lo':
+                    sysctl = Sysctl.show(sysctl_snapshot, name)
+                    if sysctl:
+                        ifs_link['sysctl'] = sysctl
+
                 if name == 'lo':
                     if ifs_link['addresses'] == Parser._default_lo_link['addresses']:
                         del(ifs_link['addresses'])
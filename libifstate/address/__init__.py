@@ -1,16 +1,79 @@
-from libifstate.util import logger, IfStateLogging
-from libifstate.exception import netlinkerror_classes
-from ipaddress import ip_interface
-from pyroute2.netlink.rtnl.ifaddrmsg import IFA_F_DADFAILED, IFA_F_PERMANENT
+from libifstate.util import logger, IfStateLogging, NetnsDump
+from ipaddress import ip_interface, IPv4Interface, IPv6Interface
+from pyroute2.netlink import NLM_F_REQUEST, NLM_F_ACK, NLM_F_CREATE, NLM_F_EXCL
+from pyroute2.netlink.rtnl import RTM_NEWADDR, RTM_DELADDR
+from pyroute2.netlink.rtnl.ifaddrmsg import ifaddrmsg, IFA_F_DADFAILED, IFA_F_PERMANENT
+from socket import AF_INET, AF_INET6, inet_pton, inet_ntop
+
+
+def pack_address(family, address, prefixlen):
+    '''
+    Pack an address into a hashable (family, address, prefixlen) tuple.
+    '''
+    return (family, int.from_bytes(inet_pton(family, address), 'big'), prefixlen)
+
+
+def unpack_address(key):
+    '''
+    Build the address string of a packed address.
+    '''
+    (family, address, prefixlen) = key
+    return inet_ntop(family, address.to_bytes(4 if family == AF_INET else 16, 'big'))
+
+
+def address_interface(key):
+    (family, address, prefixlen) = key
+    if family == AF_INET:
+        return IPv4Interface((address, prefixlen))
+    return IPv6Interface((address, prefixlen))
+
+
+class AddressDump(NetnsDump):
+    '''
+    Addresses of a netns, grouped by ifindex
+    (ifindex => packed address => (flags, IFA_FLAGS)).
+    '''
+    @staticmethod
+    def group(ipr_addresses):
+        addresses = {}
+        for addr in ipr_addresses:
+            key = pack_address(addr['family'], addr.get_attr('IFA_ADDRESS'), addr['prefixlen'])
+            addresses.setdefault(addr['index'], {})[key] = (addr['flags'], addr.get_attr('IFA_FLAGS', 0))
+        return addresses
+
+    def dump(self):
+        return self.group(self.netns.ipr.get_addr())
+
+    def dump_link(self, idx):
+        return self.group(self.netns.ipr.get_addr(index=idx)).get(idx, {})
 
 
 class Addresses():
     def __init__(self, netns, iface, addresses):
         self.netns = netns
         self.iface = iface
-        self.addresses = []
+        # packed address => ip_interface
+        self.addresses = {}
         for address in addresses:
-            self.addresses.append(ip_interface(address))
+            addr = ip_interface(address)
+            family = AF_INET if addr.version == 4 else AF_INET6
+            self.addresses[(family, int(addr.ip), addr.network.prefixlen)] = addr
+
+    def get_msg(self, idx, key, msg_type, msg_flags):
+        (family, address, prefixlen) = key
+        address = unpack_address(key)
+
+        msg = ifaddrmsg()
+        msg['family'] = family
+        msg['prefixlen'] = prefixlen
+        msg['index'] = idx
+        if family == AF_INET:
+            msg['attrs'].append(('IFA_LOCAL', address))
+        msg['attrs'].append(('IFA_ADDRESS', address))
+        msg['header']['type'] = msg_type
+        msg['header']['flags'] = msg_flags
+
+        return msg
 
     def apply(self, ignore, ign_dynamic, do_apply):
         logger.debug('getting addresses', extra={'iface': self.iface, 'netns': self.netns})
@@ -23,51 +86,54 @@ class Addresses():
             return
 
         # get active ip addresses
-        ipr_addr = {}
+        ipr_addr = dict(self.netns.address_dump.get(idx))
+        # (family, address) => packed address
+        ipr_ips = {}
         addr_add = []
-        addr_renew = []
-        for addr in self.netns.ipr.get_addr(index=idx):
-            flags = addr.get_attr('IFA_FLAGS', 0)
-            ip = ip_interface(addr.get_attr('IFA_ADDRESS') +
-                              '/' + str(addr['prefixlen']))
-            if flags & IFA_F_DADFAILED == IFA_F_DADFAILED:
-                logger.debug('{} has failed dad'.format(ip), extra={'iface': self.iface, 'netns': self.netns})
-                addr_renew.append(ip)
-            ipr_addr[ip] = addr
-
-        for addr in self.addresses:
-            if addr in ipr_addr and addr not in addr_renew:
+        addr_renew = set()
+        for key, (flags, ifa_flags) in ipr_addr.items():
+            if ifa_flags & IFA_F_DADFAILED == IFA_F_DADFAILED:
+                logger.debug('{} has failed dad'.format(address_interface(key)), extra={'iface': self.iface, 'netns': self.netns})
+                addr_renew.add(key)
+            ipr_ips[key[:2]] = key
+
+        for key, addr in self.addresses.items():
+            if key in ipr_addr and key not in addr_renew:
                 logger.log_ok('addresses', '= {}'.format(addr.with_prefixlen))
-                del ipr_addr[addr]
+                del ipr_addr[key]
             else:
-                addr_add.append(addr)
-                for ip in ipr_addr.keys():
-                    if addr.ip == ip.ip:
-                        addr_renew.append(ip)
-                        break
-
-        for ip, addr in ipr_addr.items():
-            if ip in addr_renew or not any(ip in net for net in ignore):
-                if not ign_dynamic or ipr_addr[ip]['flags'] & IFA_F_PERMANENT == IFA_F_PERMANENT:
+                addr_add.append(key)
+                # renew the ip if it has been assigned with another prefixlen
+                if key[:2] in ipr_ips:
+                    addr_renew.add(ipr_ips[key[:2]])
+
+        addr_del = []
+        for key, (flags, ifa_flags) in ipr_addr.items():
+            ip = address_interface(key)
+            if key in addr_renew or not any(ip in net for net in ignore):
+                if not ign_dynamic or flags & IFA_F_PERMANENT == IFA_F_PERMANENT:
                     logger.log_del('addresses', '- {}'.format(ip.with_prefixlen))
-                    try:
-                        if do_apply:
-                            self.netns.ipr.addr("del", index=idx, address=str(
-                                ip.ip), mask=ip.network.prefixlen)
-                    except Exception as err:
-                        if not isinstance(err, netlinkerror_classes):
-                            raise
-                        logger.warning('removing ip {}/{} failed: {}'.format(
-                            str(ip.ip), ip.network.prefixlen, err.args[1]))
-
-        for addr in addr_add:
-            logger.log_change('addresses', '+ {}'.format(addr.with_prefixlen))
-            if do_apply:
-                try:
-                    self.netns.ipr.addr("add", index=idx, address=str(
-                        addr.ip), mask=addr.network.prefixlen)
-                except Exception as err:
-                    if not isinstance(err, netlinkerror_classes):
-                        raise
-                    logger.warning('adding ip {}/{} failed: {}'.format(
-                        str(addr.ip), addr.network.prefixlen, err.args[1]))
+                    addr_del.append(key)
+
+        for key in addr_add:
+            logger.log_change('addresses', '+ {}'.format(self.addresses[key].with_prefixlen))
+
+        if not do_apply or not (addr_del or addr_add):
+            return
+
+        msgs = [self.get_msg(idx, key, RTM_DELADDR, NLM_F_REQUEST|NLM_F_ACK)
+                for key in addr_del]
+        msgs.extend(self.get_msg(idx, key, RTM_NEWADDR, NLM_F_REQUEST|NLM_F_ACK|NLM_F_CREATE|NLM_F_EXCL)
+                    for key in addr_add)
+
+        self.netns.address_dump.forget(idx)
+        if not self.netns.ipr.request_batch(msgs, 'addresses', extra={'iface': self.iface, 'netns': self.netns}):
+            ipr_addr = self.netns.address_dump.get(idx)
+            for key in addr_del:
+                if key in ipr_addr:
+                    logger.warning('removing ip {}/{} failed'.format(
+                        unpack_address(key), key[2]), extra={'iface': self.iface, 'netns': self.netns})
+            for key in addr_add:
+                if key not in ipr_addr:
+                    logger.warning('adding ip {}/{} failed'.format(
+                        unpack_address(key), key[2]), extra={'iface': self.iface, 'netns': self.netns})
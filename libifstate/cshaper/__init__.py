@@ -0,0 +1,189 @@
+from libifstate.util import logger
+from libifstate.tc import TCBlock
+
+from copy import deepcopy
+from types import MappingProxyType
+import re
+
+
+def freeze_qdisc(qdisc):
+    '''
+    Freeze a qdisc tree, the frozen tree is used as template for the
+    qdisc settings of the shaped interfaces.
+    '''
+    qdisc = dict(deepcopy(qdisc))
+    if 'children' in qdisc:
+        qdisc['children'] = tuple(freeze_qdisc(child) for child in qdisc['children'])
+
+    return MappingProxyType(qdisc)
+
+
+def thaw_qdisc(qdisc):
+    '''
+    Build the qdisc settings from a frozen template, only the dicts of
+    the tree are copied.
+    '''
+    qdisc = dict(qdisc)
+    if 'children' in qdisc:
+        qdisc['children'] = [thaw_qdisc(child) for child in qdisc['children']]
+
+    return qdisc
+
+
+class CShaperProfile():
+    '''
+    Precompiled cshaper profile.
+    '''
+    def __init__(self, name, profile):
+        self.name = name
+        self.egress_qdisc = freeze_qdisc(profile['egress_qdisc'])
+        self.ingress_qdisc = freeze_qdisc(profile['ingress_qdisc'])
+        self.ingress_block = profile.get('ingress_block')
+
+        if 'ingress_ifname' in profile:
+            self.ifname_search = re.compile(profile['ingress_ifname']['search'])
+            self.ifname_replace = profile['ingress_ifname']['replace']
+        else:
+            self.ifname_search = None
+            self.ifname_replace = None
+
+    def ifb_name(self, ifname):
+        return self.ifname_search.sub(self.ifname_replace, ifname)
+
+    def egress_tc(self, bandwidth):
+        qdisc = thaw_qdisc(self.egress_qdisc)
+        qdisc['bandwidth'] = bandwidth
+
+        return qdisc
+
+    def ingress_tc(self, bandwidth=None):
+        qdisc = thaw_qdisc(self.ingress_qdisc)
+        if bandwidth is not None:
+            qdisc['bandwidth'] = bandwidth
+
+        return qdisc
+
+
+class CShaper():
+    '''
+    Expands the cshaper settings of interfaces into tc settings and the
+    required ifb links.
+    '''
+    def __init__(self, profiles):
+        self.profiles = {
+            name: CShaperProfile(name, profile) for name, profile in profiles.items()
+        }
+
+    def expand(self, netns, ifstates):
+        '''
+        Expansion pass over the interfaces of a netns, yields the
+        interfaces followed by the ifb links required by them.
+        '''
+        ifbs = []
+        for ifstate in ifstates:
+            if 'cshaper' in ifstate:
+                ifb_state = self.expand_iface(netns, ifstate)
+                if ifb_state is not None:
+                    ifbs.append(ifb_state)
+
+            yield ifstate
+
+        yield from ifbs
+
+    def expand_iface(self, netns, ifstate):
+        name = ifstate['name']
+        cshaper = ifstate['cshaper']
+        profile = self.profiles[cshaper.get('profile', 'default')]
+        logger.debug('cshaper profile {} enabled'.format(profile.name),
+                     extra={'iface': name, 'netns': netns})
+
+        if 'tc' in ifstate:
+            logger.warning(
+                'cshaper settings replaces tc settings', extra={'iface': name, 'netns': netns})
+
+        ifb_state = None
+        if profile.ingress_block is not None:
+            # ingress: bind to the shared block of the profile
+            block = profile.ingress_block
+            if not block['index'] in netns.tc_blocks:
+                logger.debug('cshaper shared block {} => {}'.format(block['index'], block['ifname']),
+                             extra={'iface': name, 'netns': netns})
+                ifb_state = {
+                    'name': block['ifname'],
+                    'link': {
+                        'state': 'up',
+                        'kind': 'ifb',
+                    },
+                    'tc': {
+                        'qdisc': profile.ingress_tc(),
+                    }
+                }
+
+                netns.tc_blocks[block['index']] = TCBlock(
+                    netns, block['index'], {
+                        'filter': [
+                            {
+                                'kind': 'matchall',
+                                'action': [
+                                    {
+                                        'kind': 'mirred',
+                                        'direction': 'egress',
+                                        'action': 'redirect',
+                                        'dev': block['ifname'],
+                                    }
+                                ]
+                            }
+                        ]
+                    })
+
+            if 'ingress' in cshaper:
+                logger.debug('cshaper ingress bandwidth is shaped by the shared ifb',
+                             extra={'iface': name, 'netns': netns})
+
+            ifstate['tc'] = {
+                'ingress_block': block['index'],
+                'qdisc': profile.egress_tc(cshaper.get('egress', 'unlimited')),
+            }
+        else:
+            # ingress: redirect to a ifb per interface
+            ifb_name = profile.ifb_name(name)
+            logger.debug('cshaper ifb name {}'.format(ifb_name),
+                         extra={'iface': name, 'netns': netns})
+
+            ifb_state = {
+                'name': ifb_name,
+                'link': {
+                    'state': 'up',
+                    'kind': 'ifb',
+                },
+                'tc': {
+                    'qdisc': profile.ingress_tc(cshaper.get('ingress', 'unlimited')),
+                }
+            }
+
+            if 'vrrp' in ifstate:
+                ifb_state['vrrp'] = ifstate['vrrp']
+
+            ifstate['tc'] = {
+                'ingress': True,
+                'qdisc': profile.egress_tc(cshaper.get('egress', 'unlimited')),
+                'filter': [
+                    {
+                        'kind': 'matchall',
+                        'parent': 'ffff:',
+                        'action': [
+                            {
+                                'kind': 'mirred',
+                                'direction': 'egress',
+                                'action': 'redirect',
+                                'dev': ifb_name,
+                            }
+                        ]
+                    }
+
+                ]
+            }
+
+        del ifstate['cshaper']
+
+        return ifb_state
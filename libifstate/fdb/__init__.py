@@ -1,53 +1,65 @@
 from libifstate.util import logger, IfStateLogging
-from libifstate.exception import netlinkerror_classes
 from ipaddress import ip_address
-from pyroute2.netlink.rtnl.ndmsg import NUD_NOARP, NUD_PERMANENT, NTF_SELF
+from pyroute2.netlink import NLM_F_REQUEST, NLM_F_ACK, NLM_F_CREATE, NLM_F_APPEND
+from pyroute2.netlink.rtnl import RTM_NEWNEIGH, RTM_DELNEIGH
+from pyroute2.netlink.rtnl.ndmsg import ndmsg, NUD_NOARP, NUD_PERMANENT, NTF_SELF
 from pyroute2.config import AF_BRIDGE
 import pyroute2.netlink.rtnl.ndmsg
 
+# fdb entries are normalized into hashable tuples of these fields
+FDB_FIELDS = ('lladdr', 'dst', 'port', 'state', 'flags', 'nhid', 'src_vni', 'vni')
+
+# optional fields => NDA attribute
+FDB_ATTRS = {
+    'dst': 'NDA_DST',
+    'port': 'NDA_PORT',
+    'nhid': 'NDA_NH_ID',
+    'src_vni': 'NDA_SRC_VNI',
+    'vni': 'NDA_VNI',
+}
+
 class FDB():
     def __init__(self, netns, iface, fdb):
         self.netns = netns
         self.iface = iface
-        self.fdb = {}
         self.state_mask = NUD_NOARP|NUD_PERMANENT
 
+        # entries w/o state get a default state depending on the link type
+        self.fdb = {}
         for entry in fdb:
             lladdr = entry['lladdr'].lower()
-            _entry = {
-                'lladdr': lladdr,
-            }
-
-            if 'port' not in entry:
-                _entry['port'] = 8472
-            else:
-                _entry['port'] = entry['port']
 
             if 'dst' in entry:
-                _entry['dst'] = str(ip_address(entry['dst']))
+                dst = str(ip_address(entry['dst']))
+            else:
+                dst = None
 
             if 'state' in entry:
-                _entry['state'] = 0
+                state = 0
                 for name, value in pyroute2.netlink.rtnl.ndmsg.states.items():
                     if name in entry['state']:
-                        _entry['state'] |= value
+                        state |= value
+            else:
+                state = None
 
             if 'flags' in entry:
-                _entry['flags'] = 0
+                flags = 0
                 for name, value in pyroute2.netlink.rtnl.ndmsg.flags.items():
                     if name in entry['flags']:
-                        _entry['flags'] |= value
-            else:
-                _entry['flags'] = NTF_SELF
-
-            for opt in ['nhid', 'src_vni', 'vni']:
-                if opt in entry:
-                    _entry[opt] = entry[opt]
-
-            if not lladdr in self.fdb:
-                self.fdb[lladdr] = [_entry]
+                        flags |= value
             else:
-                self.fdb[lladdr].append(_entry)
+                flags = NTF_SELF
+
+            self.fdb[(
+                lladdr,
+                dst,
+                entry.get('port', 8472),
+                state,
+                flags,
+                entry.get('nhid'),
+                entry.get('src_vni'),
+                entry.get('vni'),
+            )] = True
 
     def get_kernel_fdb(self):
         # get fdb entries (NUD_NOARP|NUD_PERMANENT)
@@ -59,35 +71,42 @@ class FDB():
             if not state & self.state_mask:
                 continue
 
-            lladdr = entry.get_attr('NDA_LLADDR')
-            _entry = {
-                'lladdr': lladdr,
-                'state': state,
-                'flags': entry.get('flags')
-            }
-
-            attr = entry.get_attr('NDA_DST')
-            if attr is not None:
-                _entry['dst'] = str(ip_address(attr))
-
-            attr = entry.get_attr('NDA_PORT')
-            if attr is None or attr == 0:
-                _entry['port'] = 8472
-            else:
-                _entry['port'] = attr
-
-            for opt in ['nhid', 'src_vni', 'vni']:
-                attr = entry.get_attr(f"NDA_{opt.upper()}")
-                if attr is not None:
-                    _entry[opt] = attr
-
-            if not lladdr in fdb:
-                fdb[lladdr] = [_entry]
-            else:
-                fdb[lladdr].append(_entry)
+            dst = entry.get_attr('NDA_DST')
+            if dst is not None:
+                dst = str(ip_address(dst))
+
+            port = entry.get_attr('NDA_PORT')
+            if port is None or port == 0:
+                port = 8472
+
+            fdb[(
+                entry.get_attr('NDA_LLADDR'),
+                dst,
+                port,
+                state,
+                entry.get('flags'),
+                entry.get_attr('NDA_NH_ID'),
+                entry.get_attr('NDA_SRC_VNI'),
+                entry.get_attr('NDA_VNI'),
+            )] = True
 
         return fdb
 
+    def get_msg(self, entry, msg_type, msg_flags):
+        msg = ndmsg()
+        msg['family'] = AF_BRIDGE
+        msg['ifindex'] = self.idx
+        msg['state'] = entry[FDB_FIELDS.index('state')]
+        msg['flags'] = entry[FDB_FIELDS.index('flags')]
+        msg['attrs'].append(('NDA_LLADDR', entry[0]))
+        for field, value in zip(FDB_FIELDS, entry):
+            if field in FDB_ATTRS and value is not None:
+                msg['attrs'].append((FDB_ATTRS[field], value))
+        msg['header']['type'] = msg_type
+        msg['header']['flags'] = msg_flags
+
+        return msg
+
     def apply(self, do_apply):
         logger.debug('getting fdb', extra={'iface': self.iface})
 
@@ -108,67 +127,55 @@ class FDB():
         if linkinfo and linkinfo.get_attr('IFLA_INFO_KIND') in ['vxlan']:
             default_state |= NUD_NOARP
 
+        state_idx = FDB_FIELDS.index('state')
+        fdb = {}
+        for entry in self.fdb:
+            if entry[state_idx] is None:
+                entry = entry[:state_idx] + (default_state,) + entry[state_idx + 1:]
+            fdb[entry] = True
+
+        # a single dump serves both the add and the cleanup pass
+        ipr_fdb = self.get_kernel_fdb()
+
         # configure fdb entries
-        ipr_entries = self.get_kernel_fdb()
-        for lladdr, entries in self.fdb.items():
-            for entry in entries:
-                # set default_state if missing
-                if not 'state' in entry:
-                    entry['state'] = default_state
-
-                # check if fdb entry is already present
-                if lladdr in ipr_entries:
-                    if entry in ipr_entries[lladdr]:
-                        logger.log_ok('fdb', '= {}'.format(lladdr))
-                        continue
-
-                # fdb entry needs to be added
-                logger.log_add('fdb', '+ {}'.format(lladdr))
-
-                # prepare arguments
-                args = {
-                    'ifindex': self.idx,
-                    'family': AF_BRIDGE
-                }
-                args.update(entry)
-                logger.debug("bridge fdb append: {}".format(
-                    " ".join("{}={}".format(k, v) for k, v in args.items())))
-
-                if do_apply:
-                    try:
-                        self.netns.ipr.fdb("append", **args)
-                    except Exception as err:
-                        if not isinstance(err, netlinkerror_classes):
-                            raise
-                        logger.warning('add {} to fdb failed: {}'.format(
-                            entry['lladdr'], err.args[1]))
-
-        # cleanup orphan fdb entries
-        ipr_entries = self.get_kernel_fdb()
-        for lladdr, entries in ipr_entries.items():
-            # ignore lladdr of the link
-            if lladdr == self.lladdr:
+        add = []
+        for entry in fdb:
+            # check if fdb entry is already present
+            if entry in ipr_fdb:
+                logger.log_ok('fdb', '= {}'.format(entry[0]))
                 continue
 
-            for entry in entries:
-                # check if fdb entry is already present
-                if lladdr not in self.fdb or entry not in self.fdb[lladdr]:
-                    logger.log_del('fdb', '- {}'.format(lladdr))
-
-                    # prepare arguments
-                    args = {
-                        'ifindex': self.idx,
-                        'family': AF_BRIDGE
-                    }
-                    args.update(entry)
-                    logger.debug("bridge fdb del: {}".format(
-                        " ".join("{}={}".format(k, v) for k, v in args.items())))
-
-                    if do_apply:
-                        try:
-                            self.netns.ipr.fdb("del", **args)
-                        except Exception as err:
-                            if not isinstance(err, netlinkerror_classes):
-                                raise
-                            logger.warning('remove {} from fdb failed: {}'.format(
-                                entry['lladdr'], err.args[1]))
+            # fdb entry needs to be added
+            logger.log_add('fdb', '+ {}'.format(entry[0]))
+            logger.debug("bridge fdb append: {}".format(
+                " ".join("{}={}".format(k, v) for k, v in zip(FDB_FIELDS, entry) if v is not None)))
+            add.append(entry)
+
+        # cleanup orphan fdb entries (ignore lladdr of the link)
+        delete = []
+        for entry in ipr_fdb:
+            if entry[0] != self.lladdr and entry not in fdb:
+                logger.log_del('fdb', '- {}'.format(entry[0]))
+                logger.debug("bridge fdb del: {}".format(
+                    " ".join("{}={}".format(k, v) for k, v in zip(FDB_FIELDS, entry) if v is not None)))
+                delete.append(entry)
+
+        if not do_apply or not (add or delete):
+            return
+
+        # deletes go first: an entry with changed settings might share
+        # its key (lladdr, dst) with an orphan entry
+        msgs = [self.get_msg(entry, RTM_DELNEIGH, NLM_F_REQUEST|NLM_F_ACK)
+                for entry in delete]
+        msgs.extend(self.get_msg(entry, RTM_NEWNEIGH, NLM_F_REQUEST|NLM_F_ACK|NLM_F_CREATE|NLM_F_APPEND)
+                    for entry in add)
+        if not self.netns.ipr.request_batch(msgs, 'fdb', extra={'iface': self.iface}):
+            ipr_fdb = self.get_kernel_fdb()
+            for entry in add:
+                if entry not in ipr_fdb:
+                    logger.warning('add {} to fdb failed'.format(entry[0]),
+                                   extra={'iface': self.iface})
+            for entry in delete:
+                if entry in ipr_fdb:
+                    logger.warning('remove {} from fdb failed'.format(entry[0]),
+                                   extra={'iface': self.iface})
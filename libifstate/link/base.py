@@ -7,13 +7,14 @@ import os
 import subprocess
 import yaml
 import shutil
-import copy
 import pyroute2.netns
 
 ethtool_path = shutil.which("ethtool") or '/usr/sbin/ethtool'
 
 class Link(ABC):
     _nla_prefix = 'IFLA_'
+    _nla_names = {}
+    _attr_paths = {}
     _classes = {}
     attr_value_maps = {
         # === bond ===
@@ -83,6 +84,10 @@ class Link(ABC):
             2: 'inherit',
         },
     }
+    # reverse mappings of attr_value_maps (name => value)
+    attr_value_rmaps = {
+        attr: {v: k for k, v in mappings.items()} for attr, mappings in attr_value_maps.items()
+    }
     attr_value_lookup = {
         'group': RTLookups.group,
         'vrf_table': RTLookups.tables,
@@ -104,18 +109,24 @@ class Link(ABC):
         'wireguard',
         'xfrm',
     ]
+    attr_map = {
+        'kind': ('IFLA_LINKINFO', 'IFLA_INFO_KIND'),
+    }
+    attr_idx = ['link', 'master', 'gre_link',
+                'ip6gre_link', 'vxlan_link', 'xfrm_link']
 
-    def __new__(cls, *args, **kwargs):
-        cname = cls.__name__
-        if cname == Link.__name__:
-            cname = "{}Link".format(args[3]['kind'].lower().capitalize())
+    def __init_subclass__(cls, **kwargs):
+        '''
+        Register link classes by their kind (i.e. VethLink => veth).
+        '''
+        super().__init_subclass__(**kwargs)
+        Link._classes[cls.__name__[:-len('Link')].lower()] = cls
 
-        for c in Link.__subclasses__():
-            if c.__name__ == cname:
-                return super().__new__(c)
+    def __new__(cls, *args, **kwargs):
+        if cls is Link:
+            cls = Link._classes.get(args[3]['kind'].lower(), GenericLink)
 
-        return super().__new__(GenericLink)
-        #raise LinkTypeUnknown()
+        return super().__new__(cls)
 
     def __init__(self, ifstate, netns, name, link, ethtool, vrrp, brport):
         self.ifstate = ifstate
@@ -132,11 +143,6 @@ class Link(ABC):
             self.brport = BRPort(netns, name, brport)
         else:
             self.brport = None
-        self.attr_map = {
-            'kind': ['IFLA_LINKINFO', 'IFLA_INFO_KIND'],
-        }
-        self.attr_idx = ['link', 'master', 'gre_link',
-                         'ip6gre_link', 'vxlan_link', 'xfrm_link']
         self.idx = None
         self.link_registry_search_args = []
         self.link_ref = LinkDependency(name, self.netns.netns)
@@ -179,10 +185,10 @@ class Link(ABC):
 
         self.search_link_registry()
 
-        for attr, mappings in self.attr_value_maps.items():
-            if attr in self.settings and type(self.settings[attr]) != int:
-                self.settings[attr] = next((k for k, v in mappings.items(
-                ) if v == self.settings[attr]), self.settings[attr])
+        for attr in self.attr_value_rmaps.keys() & self.settings.keys():
+            if type(self.settings[attr]) != int:
+                self.settings[attr] = self.attr_value_rmaps[attr].get(
+                    self.settings[attr], self.settings[attr])
 
         for attr, lookup in self.attr_value_lookup.items():
             if attr in self.settings and type(self.settings[attr]) != int:
@@ -221,16 +227,38 @@ class Link(ABC):
         return None
 
     def _drill_attr(self, data, keys):
-        key = keys[0]
-        d = data.get_attr(key)
+        for key in keys:
+            # IFLA_INFO_DATA of unsupported link types is a raw string
+            op = getattr(data, 'get_attr', None)
+            if not callable(op):
+                return None
 
-        if d is not None:
-            if len(keys) > 1:
-                return self._drill_attr(d, keys[1:])
+            data = op(key)
+            if data is None:
+                return None
+
+        return data
+
+    @classmethod
+    def attr_paths(cls, key):
+        '''
+        Get the NLA paths to lookup a setting in a link's ifinfmsg. The
+        paths are build once per setting name.
+        '''
+        paths = cls._attr_paths.get(key)
+        if paths is None:
+            if key in cls.attr_map:
+                paths = (cls.attr_map[key],)
             else:
-                return d
-        else:
-            return None
+                nla = cls.name2nla(key)
+                paths = (
+                    (nla,),
+                    ('IFLA_LINKINFO', nla),
+                    ('IFLA_LINKINFO', 'IFLA_INFO_DATA', nla),
+                )
+            cls._attr_paths[key] = paths
+
+        return paths
 
     def get_if_attr(self, key):
         if key in ["state", "permaddr", "businfo"]:
@@ -239,28 +267,11 @@ class Link(ABC):
             else:
                 return None
 
-        if key in self.attr_map:
-            return self._drill_attr(self.iface, self.attr_map[key])
-
-        nla = self.name2nla(key)
-        ret = self.iface.get_attr(nla)
-        if not ret is None:
-            return ret
-
-        info = self.iface.get_attr('IFLA_LINKINFO')
-        op = getattr(info, 'get_attr', None)
-        if callable(op):
-            ret = op(nla)
+        for path in self.attr_paths(key):
+            ret = self._drill_attr(self.iface, path)
             if not ret is None:
                 return ret
 
-            info = op('IFLA_INFO_DATA')
-            op = getattr(info, 'get_attr', None)
-            if callable(op):
-                ret = op(nla)
-                if not ret is None:
-                    return ret
-
         return None
 
     def get_ethtool_fn(self, setting):
@@ -426,44 +437,67 @@ class Link(ABC):
     def match_vrrp_state(self, vrrp_type, vrrp_name, vrrp_state):
         return self.match_vrrp_select(vrrp_type, vrrp_name) and (vrrp_state in self.vrrp['states'])
 
-    def apply(self, do_apply, sysctl):
-        excpts = ExceptionCollector(self.settings['ifname'])
-        osettings = copy.deepcopy(self.settings)
+    def resolve_settings(self, overrides=None):
+        '''
+        Build the settings of a single apply run as a overlay of the
+        configured settings: overrides (i.e. the vrrp state) are applied
+        and interface references are resolved into interface indexes.
+        The configured settings are not modified.
+        '''
+        settings = dict(self.settings)
+        if overrides:
+            settings.update(overrides)
 
         # lookup for attributes requiring a interface index
         for attr in self.attr_idx:
-            if self.settings.get(attr) is not None:
+            if settings.get(attr) is not None:
                 netns_attr = "{}_netns".format(attr)
                 netnsid_attr = "{}_netnsid".format(attr)
-                if netns_attr in self.settings:
+                if netns_attr in settings:
                     # ToDo: throw exception for unknown netns
-                    (peer_ipr, peer_nsid) = self.netns.get_netnsid(self.settings[netns_attr])
-                    self.settings[netnsid_attr] = peer_nsid
+                    (peer_ipr, peer_nsid) = self.netns.get_netnsid(settings[netns_attr])
+                    settings[netnsid_attr] = peer_nsid
                     idx = next(iter(peer_ipr.link_lookup(
-                        ifname=self.settings[attr])), None)
+                        ifname=settings[attr])), None)
 
-                    del(self.settings[netns_attr])
+                    del(settings[netns_attr])
                 else:
                     idx = next(iter(self.netns.ipr.link_lookup(
-                        ifname=self.settings[attr])), None)
+                        ifname=settings[attr])), None)
 
                 if idx is not None:
-                    self.settings[attr] = idx
+                    settings[attr] = idx
                 else:
                     logger.warning('could not find %s "%s"', attr,
-                        self.settings[attr],
+                        settings[attr],
                         extra={
-                            'iface': self.settings['ifname'],
+                            'iface': settings['ifname'],
                             'netns': self.netns})
-                    self.settings['state'] = 'down'
-                    if netnsid_attr in self.settings:
-                        del(self.settings[netnsid_attr])
-                    del(self.settings[attr])
-            elif attr in self.settings:
+                    settings['state'] = 'down'
+                    if netnsid_attr in settings:
+                        del(settings[netnsid_attr])
+                    del(settings[attr])
+            elif attr in settings:
                 # unset index references have a None state,
                 # but configuration requires the invalid ifindex 0
-                self.settings[attr] = 0
+                settings[attr] = 0
+
+        return settings
+
+    def apply(self, do_apply, sysctl, overrides=None):
+        excpts = ExceptionCollector(self.settings['ifname'])
 
+        # work on the resolved settings while applying, the model
+        # keeps the configured settings for later runs
+        configured = self.settings
+        self.settings = self.resolve_settings(overrides)
+        self.idx = None
+        try:
+            return self._apply(do_apply, sysctl, excpts)
+        finally:
+            self.settings = configured
+
+    def _apply(self, do_apply, sysctl, excpts):
         # get interface from registry
         item = self.search_link_registry()
 
@@ -473,7 +507,6 @@ class Link(ABC):
                 self.idx = item.index
                 self.recreate(do_apply, sysctl, excpts)
 
-                self.settings = osettings
                 return excpts
         except NetnsUnknown as ex:
             excpts.add('apply', ex)
@@ -531,13 +564,12 @@ class Link(ABC):
         else:
             self.create(do_apply, sysctl, excpts)
 
-        self.settings = osettings
         return excpts
 
     def create(self, do_apply, sysctl, excpts, oper="add"):
         logger.log_add('link', oper)
 
-        settings = copy.deepcopy(self.settings)
+        settings = dict(self.settings)
         try:
             bind_netns = self.get_bind_netns()
         except NetnsUnknown as ex:
@@ -804,6 +836,10 @@ class Link(ABC):
             else:
                 logger.log_ok('link')
 
+        # reconfigured links might lose addresses and neighbours (i.e. when going down)
+        if do_apply and (has_link_changes or has_state_changes or has_brport_changes):
+            self.netns.forget_dumps(self.idx)
+
     def depends(self):
         deps = []
 
@@ -828,24 +864,14 @@ class Link(ABC):
         logger.debug('checking altname conflict', extra={
                      'iface': self.settings['ifname'], 'netns': self.netns})
 
-        # get link candidate having the ifname as altname
-        try:
-            link = next(
-                iter(self.netns.ipr.link('get', altname=self.settings['ifname'])), None)
-        except Exception as err:
-            if not isinstance(err, netlinkerror_classes):
-                raise
-            return
-
-        # pyroute2 may return the interface having ifname rather than
-        # altname set - only remove altname if it is set
-        properties = link.get_attr('IFLA_PROP_LIST')
-        if properties is not None and self.settings['ifname'] in properties.get_attrs('IFLA_ALT_IFNAME'):
-            logger.debug('  found: %s (%d)', link.get_attr(
-                'IFLA_IFNAME'), link['index'], extra={'iface': self.settings['ifname'], 'netns': self.netns})
+        # get link candidate having the ifname as altname from the
+        # altnames collected by the link registry
+        item = self.ifstate.link_registry.get_altname(self.netns, self.settings['ifname'])
+        if item is not None:
+            logger.debug('  found: %s (%d)', item.attributes['ifname'], item.index,
+                         extra={'iface': self.settings['ifname'], 'netns': self.netns})
             try:
-                self.netns.ipr.link('property_del',
-                         index=link['index'], altname=self.settings['ifname'])
+                item.del_altname(self.settings['ifname'])
             except Exception as err:
                 if not isinstance(err, netlinkerror_classes):
                     raise
@@ -859,10 +885,13 @@ class Link(ABC):
 
         Requires self.prefix to be set
         '''
-        name = name.upper()
-        if name.find(self._nla_prefix) == -1:
-            name = "%s%s" % (self._nla_prefix, name)
-        return name
+        nla = self._nla_names.get(name)
+        if nla is None:
+            nla = name.upper()
+            if nla.find(self._nla_prefix) == -1:
+                nla = "%s%s" % (self._nla_prefix, nla)
+            self._nla_names[name] = nla
+        return nla
 
 
 class GenericLink(Link):
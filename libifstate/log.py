@@ -120,12 +120,25 @@ class IfStateLogging:
             handlers.append(logging.NullHandler())
 
         qu = queue.SimpleQueue()
-        queue_handler = QueueHandler(qu)
-        queue_handler.setLevel(level)
-        logger.addHandler(queue_handler)
+        self.queue_handler = QueueHandler(qu)
+        self.queue_handler.setLevel(level)
+        logger.addHandler(self.queue_handler)
         self.listener = QueueListener(
             qu, *handlers, respect_handler_level=True)
         self.listener.start()
 
+    def after_fork(self):
+        '''
+        Restart the queue listener in a forked process, the listener
+        thread does not survive fork().
+        '''
+        # the inherited queue might be locked by the parent's listener
+        # and holds records written by the parent process
+        qu = queue.SimpleQueue()
+        self.queue_handler.queue = qu
+        self.listener = QueueListener(
+            qu, *self.listener.handlers, respect_handler_level=True)
+        self.listener.start()
+
     def quit(self):
         self.listener.stop()
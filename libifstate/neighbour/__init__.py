@@ -1,6 +1,29 @@
-from libifstate.util import logger, IfStateLogging
-from libifstate.exception import netlinkerror_classes
+from libifstate.util import logger, IfStateLogging, NetnsDump
 from ipaddress import ip_address
+from pyroute2.netlink import NLM_F_REQUEST, NLM_F_ACK, NLM_F_CREATE, NLM_F_REPLACE
+from pyroute2.netlink.rtnl import RTM_NEWNEIGH, RTM_DELNEIGH
+from pyroute2.netlink.rtnl.ndmsg import ndmsg, NUD_PERMANENT
+from socket import AF_INET, AF_INET6
+
+
+class NeighbourDump(NetnsDump):
+    '''
+    Permanent neighbours of a netns, dumped once per family and grouped
+    by ifindex (ifindex => ip => lladdr).
+    '''
+    def group(self, **kwargs):
+        neighbours = {}
+        for family in [AF_INET, AF_INET6]:
+            for neigh in self.netns.ipr.get_neighbours(family=family, state=NUD_PERMANENT, **kwargs):
+                ip = ip_address(neigh.get_attr('NDA_DST'))
+                neighbours.setdefault(neigh['ifindex'], {})[ip] = neigh.get_attr('NDA_LLADDR')
+        return neighbours
+
+    def dump(self):
+        return self.group()
+
+    def dump_link(self, idx):
+        return self.group(ifindex=idx).get(idx, {})
 
 
 class Neighbours():
@@ -11,6 +34,19 @@ class Neighbours():
         for neigh in neighbours:
             self.neighbours[ip_address(neigh['dst'])] = neigh.get('lladdr')
 
+    def get_msg(self, idx, ip, lladdr, msg_type, msg_flags):
+        msg = ndmsg()
+        msg['family'] = AF_INET if ip.version == 4 else AF_INET6
+        msg['ifindex'] = idx
+        msg['state'] = NUD_PERMANENT
+        msg['attrs'].append(('NDA_DST', str(ip)))
+        if lladdr is not None:
+            msg['attrs'].append(('NDA_LLADDR', lladdr))
+        msg['header']['type'] = msg_type
+        msg['header']['flags'] = msg_flags
+
+        return msg
+
     def apply(self, do_apply):
         logger.debug('getting neighbours', extra={'iface': self.iface})
 
@@ -22,11 +58,8 @@ class Neighbours():
             return
 
         # get neighbour entries (only NUD_PERMANENT)
-        ipr_neigh = {}
+        ipr_neigh = dict(self.netns.neighbour_dump.get(idx))
         neigh_add = {}
-        for neigh in self.netns.ipr.get_neighbours(ifindex=idx, state=128):
-            ip = ip_address(neigh.get_attr('NDA_DST'))
-            ipr_neigh[ip] = neigh.get_attr('NDA_LLADDR')
 
         for ip, lladdr in self.neighbours.items():
             if ip in ipr_neigh and lladdr == ipr_neigh[ip]:
@@ -35,32 +68,27 @@ class Neighbours():
             else:
                 neigh_add[ip] = lladdr
 
+        msgs = []
         for ip, lladdr in ipr_neigh.items():
             logger.log_del('neighbours', '- {}'.format(str(ip)))
-            try:
-                if do_apply:
-                    self.netns.ipr.neigh("del", ifindex=idx, dst=str(
-                        ip))
-            except Exception as err:
-                if not isinstance(err, netlinkerror_classes):
-                    raise
-                logger.warning('removing neighbour {} failed: {}'.format(
-                    str(ip), err.args[1]))
+            msgs.append(self.get_msg(idx, ip, None, RTM_DELNEIGH, NLM_F_REQUEST|NLM_F_ACK))
 
         for ip, lladdr in neigh_add.items():
             logger.log_add('neighbours', '+ {}'.format(str(ip)))
-            if do_apply:
-                try:
-                    opts = {
-                        'ifindex': idx,
-                        'dst': str(ip),
-                        'lladdr': lladdr,
-                        'state': 128
-                    }
-
-                    self.netns.ipr.neigh('replace', **opts)
-                except Exception as err:
-                    if not isinstance(err, netlinkerror_classes):
-                        raise
-                    logger.warning('adding neighbour {} failed: {}'.format(
-                        str(ip), err.args[1]))
+            msgs.append(self.get_msg(idx, ip, lladdr, RTM_NEWNEIGH,
+                                     NLM_F_REQUEST|NLM_F_ACK|NLM_F_CREATE|NLM_F_REPLACE))
+
+        if not do_apply or not msgs:
+            return
+
+        self.netns.neighbour_dump.forget(idx)
+        if not self.netns.ipr.request_batch(msgs, 'neighbours', extra={'iface': self.iface}):
+            ipr_neigh = self.netns.neighbour_dump.get(idx)
+            for ip in neigh_add.keys():
+                if ipr_neigh.get(ip) != self.neighbours[ip]:
+                    logger.warning('adding neighbour {} failed'.format(str(ip)),
+                                   extra={'iface': self.iface})
+            for ip in ipr_neigh.keys():
+                if ip not in self.neighbours:
+                    logger.warning('removing neighbour {} failed'.format(str(ip)),
+                                   extra={'iface': self.iface})
@@ -1,23 +1,30 @@
-from libifstate.util import logger, IfStateLogging, IPRouteExt, NetNSExt, root_ipr, root_iw
+from libifstate.util import logger, IfStateLogging, IPRouteExt, root_ipr, root_iw, netns_path, netns_sockets, netns_iproute
+from libifstate.address import AddressDump
+from libifstate.neighbour import NeighbourDump
 from libifstate.sysctl import Sysctl
+from libifstate.tc import TCDump
 
 import atexit
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+import itertools
 import logging
+import os
 import pyroute2
 import re
 import secrets
-import shutil
-import subprocess
 
 netns_name_map = {}
 netns_name_root = None
 netns_nsid_map = {}
 iw_ifindex_phy_map = {}
-findmnt_cmd = shutil.which('findmnt')
+mountinfo_index = None
 
-if findmnt_cmd is None:
-    logger.debug("findmnt binary is not available, netns binding of links might not be correct")
+# max. number of namespaces opened or removed concurrently
+NETNS_WORKERS = 16
+
+# whitespace and backslashes are octal escaped in mountinfo
+REGEX_MOUNTINFO_ESCAPE = re.compile(rb'\\([0-7]{3})')
 
 @atexit.register
 def close_netns():
@@ -28,13 +35,15 @@ def close_netns():
         pyroute2.netns.remove(netns_name_root)
 
 class NetNameSpace():
-    def __init__(self, name):
+    def __init__(self, name, sockets=None):
         self.netns = name
         self.links = {}
         self.addresses = {}
+        self.address_dump = AddressDump(self)
         self.bpf_progs = None
         self.fdb = {}
         self.neighbours = {}
+        self.neighbour_dump = NeighbourDump(self)
         self.vrrp = {
             'links': [],
             'group': {},
@@ -44,6 +53,8 @@ class NetNameSpace():
         self.rules = None
         self.sysctl = Sysctl(self)
         self.tc = {}
+        self.tc_blocks = {}
+        self.tc_dump = TCDump(self)
         self.wireguard = {}
         self.xdp = {}
 
@@ -52,25 +63,57 @@ class NetNameSpace():
             self.iw = root_iw
             self.mount = b''
         else:
-            self.ipr = NetNSExt(name)
+            # open the sockets inside of the netns, no NetNS proxy required
+            if sockets is None:
+                sockets = netns_sockets(name)
+            (self.ipr, self.iw) = NetNameSpace.wrap_sockets(sockets)
             netns_name_map[name] = self.ipr
+            forget_netnsids(name)
 
-            # check for wireless phys
-            pyroute2.netns.pushns(name)
-            try:
-                self.iw = pyroute2.IW()
-            finally:
-                pyroute2.netns.popns()
-
-            if findmnt_cmd is None:
-                self.mount = name.encode("utf-8")
-            else:
-                self.mount = subprocess.check_output([findmnt_cmd, '-f', '-J', "/run/netns/{}".format(name)])
+            self.mount = get_netns_mount(name)
 
         for ifname, ifdict in self.iw.get_interfaces_dict().items():
             # ifIndex => phyIndex
             iw_ifindex_phy_map[ifdict[0]] = ifdict[3]
 
+    def reset_dumps(self):
+        '''
+        Drop the netlink dumps (tc, neighbours, addresses), the state might
+        have been changed since the last run.
+        '''
+        for dump in (self.tc_dump, self.neighbour_dump, self.address_dump):
+            dump.reset()
+
+    def forget_dumps(self, idx):
+        '''
+        Refresh the dumped state of a link on the next lookup.
+        '''
+        for dump in (self.tc_dump, self.neighbour_dump, self.address_dump):
+            dump.forget(idx)
+
+    def reopen(self):
+        '''
+        Replace the sockets by new ones, required after fork() since
+        netlink sockets must not be shared between processes.
+        '''
+        global root_ipr
+
+        if self.netns is None:
+            self.ipr = IPRouteExt()
+            self.iw = pyroute2.IW()
+            root_ipr = self.ipr
+        else:
+            (self.ipr, self.iw) = NetNameSpace.wrap_sockets(netns_sockets(self.netns))
+            netns_name_map[self.netns] = self.ipr
+
+        forget_netnsids(self.netns)
+
+    @staticmethod
+    def wrap_sockets(sockets):
+        (rtnl_sock, genl_sock, ioctl_sock) = sockets
+        return (IPRouteExt(fileno=rtnl_sock.detach(), ioctl_sock=ioctl_sock),
+                pyroute2.IW(fileno=genl_sock.detach()))
+
     def __deepcopy__(self, memo):
         '''
         Add custom deepcopy implementation to keep single IPRoute and NetNS instances.
@@ -80,32 +123,98 @@ class NetNameSpace():
         memo[id(self)] = result
         for k, v in self.__dict__.items():
             if k == 'ipr':
-                if self.netns is None:
-                    setattr(result, k, IPRouteExt())
-                else:
-                    setattr(result, k, NetNSExt(self.netns))
+                setattr(result, k, netns_iproute(self.netns))
             else:
                 setattr(result, k, deepcopy(v, memo))
         return result
 
     def get_netnsid(self, peer_netns_name):
+        '''
+        Get the nsid of a peer netns within this netns. The nsids are
+        cached in the netns_nsid_map matrix, only the first lookup of a
+        netns pair requires netlink requests.
+        '''
         if peer_netns_name is None:
             peer_ipr = root_ipr
-            peer_pid = 1
         else:
             peer_ipr = netns_name_map[peer_netns_name]
-            peer_pid = peer_ipr.child
-
-        result = self.ipr.get_netnsid(pid=peer_pid)
-        if result['nsid'] == 4294967295:
-            self.ipr.set_netnsid(pid=peer_pid)
-            result = self.ipr.get_netnsid(pid=peer_pid)
 
-        peer_nsid = result['nsid']
+        key = (self.netns, peer_netns_name)
+        peer_nsid = netns_nsid_map.get(key)
+        if peer_nsid is None:
+            peer_nsid = self.query_netnsid(peer_netns_name)
+            netns_nsid_map[key] = peer_nsid
 
         return (peer_ipr, peer_nsid)
 
+    def query_netnsid(self, peer_netns_name):
+        peer_fd = os.open(netns_path(peer_netns_name), os.O_RDONLY)
+        try:
+            result = self.ipr.get_netnsid(fd=peer_fd)
+            if result['nsid'] == 4294967295:
+                self.ipr.set_netnsid(fd=peer_fd)
+                result = self.ipr.get_netnsid(fd=peer_fd)
+        finally:
+            os.close(peer_fd)
+
+        return result['nsid']
+
+def forget_netnsids(netns_name):
+    '''
+    Drop the cached nsids of a netns which has been (re)created or removed.
+    '''
+    for key in [key for key in netns_nsid_map if netns_name in key]:
+        del netns_nsid_map[key]
+
+def reset_netnsids():
+    '''
+    Drop all cached nsids, the namespaces might have been recreated by
+    someone else since they have been cached.
+    '''
+    netns_nsid_map.clear()
+
+def parse_mountinfo():
+    '''
+    Parse /proc/self/mountinfo into a dict indexed by the mount point
+    containing (fstype, root) tuples.
+    '''
+    index = {}
+    with open('/proc/self/mountinfo', 'rb') as fh:
+        for line in fh:
+            fields = line.split()
+            # optional fields are terminated by a single hyphen
+            sep = fields.index(b'-', 6)
+            mountpoint = REGEX_MOUNTINFO_ESCAPE.sub(
+                lambda m: bytes([int(m.group(1), 8)]), fields[4]).decode('utf-8')
+            index[mountpoint] = (fields[sep + 1], fields[3])
+
+    return index
+
+def get_netns_mount(name):
+    '''
+    Get the identity of a named netns bind mount. The nsfs root of the
+    mount (i.e. `net:[4026532205]`) contains the inode of the netns and
+    changes if the netns gets recreated. The mountinfo is parsed only
+    once and refreshed if the netns has been created after parsing.
+    '''
+    global mountinfo_index
+
+    mountpoint = os.path.realpath(os.path.join(pyroute2.netns.NETNS_RUN_DIR, name))
+    if mountinfo_index is None or mountpoint not in mountinfo_index:
+        mountinfo_index = parse_mountinfo()
+
+    (fstype, root) = mountinfo_index.get(mountpoint, (None, None))
+    if fstype != b'nsfs':
+        logger.debug("netns %s is not a nsfs mount, netns binding of links might not be correct", name)
+        return name.encode("utf-8")
+
+    return root
+
 def prepare_netns(do_apply, target_netns_list, new_netns_list):
+    '''
+    Create and remove namespaces to match the config. Returns the names
+    of the orphan namespaces which are (or would be) removed.
+    '''
     logger.info("configure network namespaces...")
 
     # get mapping of netns names to lists of pids
@@ -115,6 +224,7 @@ def prepare_netns(do_apply, target_netns_list, new_netns_list):
     current_netns_list = pyroute2.netns.listnetns()
     names_set = set(list(target_netns_list) + current_netns_list)
 
+    orphan_netns_list = []
     for name in sorted(names_set):
         # cleanup orphan netns
         if name not in target_netns_list:
@@ -123,9 +233,7 @@ def prepare_netns(do_apply, target_netns_list, new_netns_list):
                     'pids: {}'.format(', '.join((str(x) for x in ns_pids[name]))),
                     extra={'iface': name})
             logger.log_del(name)
-
-            if do_apply:
-                pyroute2.netns.remove(name)
+            orphan_netns_list.append(name)
 
         # create missing netns
         elif name not in current_netns_list or name in new_netns_list:
@@ -135,6 +243,40 @@ def prepare_netns(do_apply, target_netns_list, new_netns_list):
         else:
             logger.log_ok(name)
 
+    # the log is written in order, the removal itself is done concurrently
+    if do_apply and orphan_netns_list:
+        with ThreadPoolExecutor(max_workers=min(len(orphan_netns_list), NETNS_WORKERS)) as executor:
+            # propagate unexpected exceptions
+            list(executor.map(pyroute2.netns.remove, orphan_netns_list))
+
+        for name in orphan_netns_list:
+            forget_netnsids(name)
+
+    return orphan_netns_list
+
+def open_namespaces(names):
+    '''
+    Open the named namespaces (creating missing ones) and dump their links
+    using a bounded worker pool. Returns a list of (NetNameSpace, links)
+    tuples in the order of names.
+    '''
+    if not names:
+        return []
+
+    def open_netns(name):
+        sockets = netns_sockets(name)
+
+        # pyroute2 may bind an IPRoute instance to the thread which has
+        # created it, the links are dumped using a duplicate of the netns
+        # socket and the NetNameSpace is built by the calling thread
+        with IPRouteExt(fileno=os.dup(sockets[0].fileno())) as ipr:
+            return (sockets, tuple(ipr.get_links()))
+
+    with ThreadPoolExecutor(max_workers=min(len(names), NETNS_WORKERS)) as executor:
+        opened = list(executor.map(open_netns, names))
+
+    return [(NetNameSpace(name, sockets), links) for name, (sockets, links) in zip(names, opened)]
+
 def get_netns_root():
     global netns_name_root
 
@@ -149,25 +291,46 @@ def get_netns_root():
             return name
 
 _netns_instances = {}
+def get_netns_instance(netns_name):
+    '''
+    Get a cached NetNameSpace instance of a named netns which is not
+    managed by the config. Returns None if the netns cannot be opened.
+    '''
+    if not netns_name in _netns_instances:
+        try:
+            _netns_instances[netns_name] = NetNameSpace(netns_name)
+        except OSError as ex:
+            if ex.errno == 22:
+                logger.warn("Cannot open netns %s: %s", netns_name, ex.strerror)
+                return None
+            else:
+               raise ex
+
+    return _netns_instances[netns_name]
+
+def reopen_namespaces(namespaces):
+    '''
+    Reopen the sockets of the namespaces and of all cached unmanaged
+    netns instances.
+    '''
+    for namespace in itertools.chain(namespaces, _netns_instances.values()):
+        namespace.reopen()
+
+    reset_netnsids()
+
 def get_netns_instances():
-    global _netns_instances
-    for netns_name in pyroute2.netns.listnetns():
-        if not netns_name in _netns_instances:
-            try:
-                _netns_instances[netns_name] = NetNameSpace(netns_name)
-            except OSError as ex:
-                if ex.errno == 22:
-                    logger.warn("Cannot open netns %s: %s", netns_name, ex.strerror)
-                else:
-                   raise ex
-
-    return _netns_instances.values()
+    instances = (get_netns_instance(netns_name) for netns_name in pyroute2.netns.listnetns())
+    return [instance for instance in instances if instance is not None]
 
 class LinkRegistry():
     def __init__(self, ignores, root_netns):
         self.ignores = ignores
         self.root_netns = root_netns
 
+        # namespaces managed by the config, unmanaged namespaces are
+        # only inventoried if a lookup requires them
+        self.namespaces = {None: root_netns}
+
         self.rebuild_registry()
 
     def __deepcopy__(self, memo):
@@ -184,44 +347,132 @@ class LinkRegistry():
         return result
 
     def rebuild_registry(self):
-        self.registry = []
+        # dict used as a ordered set to allow O(1) removals
+        self.registry = {}
+        self.altnames = {}
+        self.unmanaged_inventoried = False
 
-        self.inventory_netns(self.root_netns)
-        for namespace in get_netns_instances():
+        for namespace in self.namespaces.values():
             self.inventory_netns(namespace)
 
         if logger.getEffectiveLevel() <= logging.DEBUG:
             self.debug_dump()
 
+    def add_netns(self, netns, links=None):
+        '''
+        Add a netns managed by the config and inventory its links.
+        '''
+        self.namespaces[netns.netns] = netns
+        self.inventory_netns(netns, links)
+
+    def inventory_unmanaged(self):
+        '''
+        Inventory the links of all namespaces not managed by the config.
+        '''
+        if self.unmanaged_inventoried:
+            return
+
+        self.unmanaged_inventoried = True
+        for netns_name in pyroute2.netns.listnetns():
+            if netns_name in self.namespaces:
+                continue
+
+            namespace = get_netns_instance(netns_name)
+            if namespace is not None:
+                logger.debug('inventory unmanaged netns', extra={'netns': namespace})
+                self.inventory_netns(namespace)
+
     def add_link(self, netns, link):
         item = LinkRegistryItem(
             self,
             netns,
             link,
         )
-        self.registry.append(item)
+        self.registry[item] = None
+        self.index_altnames(item)
+        netns.sysctl.forget(item.attributes['ifname'])
+        netns.forget_dumps(item.index)
         return item
 
+    def remove_link(self, item):
+        self.unindex_altnames(item)
+        item.netns.sysctl.forget(item.attributes['ifname'])
+        del self.registry[item]
+
+    def refresh_links(self, links):
+        '''
+        Refresh the items of some config links from the kernel: the items
+        having the ifname of a link and the items bound to a link by a
+        previous run. All other items are kept as they are.
+        '''
+        names = set((link.netns.netns, link.settings['ifname']) for link in links)
+        bound = set(id(link) for link in links)
+        stale = [item for item in self.registry
+                 if id(item.link) in bound or (item.netns.netns, item.attributes['ifname']) in names]
+
+        # (netns name, index) => (netns, link)
+        found = {}
+        def lookup(netns, **kwargs):
+            link = netns.ipr.get_link(**kwargs)
+            if link is not None:
+                found[(netns.netns, link['index'])] = (netns, link)
+
+        for item in stale:
+            self.remove_link(item)
+            lookup(item.netns, index=item.index)
+
+        for link in links:
+            lookup(link.netns, ifname=link.settings['ifname'])
+
+        for (netns, link) in found.values():
+            self.add_link(netns, link)
+
     def get_link(self, **attributes):
+        item = self._find_link(attributes)
+
+        # lookup not limited to a managed netns, unmanaged namespaces
+        # might hold the link (i.e. a moved physical link)
+        if item is None and not self.unmanaged_inventoried and \
+                ('netns' not in attributes or attributes['netns'] not in self.namespaces):
+            self.inventory_unmanaged()
+            item = self._find_link(attributes)
+
+        return item
+
+    def _find_link(self, attributes):
         for link in self.registry:
             if link.match(**attributes):
                 return link
         return None
 
-    def inventory_netns(self, target_netns):
-        for link in target_netns.ipr.get_links():
-            self.registry.append(LinkRegistryItem(
-                self,
-                target_netns,
-                link,
-            ))
+    def index_altnames(self, item):
+        for altname in item.altnames:
+            self.altnames[(item.netns.netns, altname)] = item
+
+    def unindex_altnames(self, item):
+        for altname in item.altnames:
+            self.altnames.pop((item.netns.netns, altname), None)
+
+    def get_altname(self, netns, altname):
+        '''
+        Get the registry item having a altname (IFLA_ALT_IFNAME) set
+        in the netns.
+        '''
+        return self.altnames.get((netns.netns, altname))
+
+    def inventory_netns(self, target_netns, links=None):
+        if links is None:
+            links = target_netns.ipr.get_links()
+
+        for link in links:
+            self.add_link(target_netns, link)
 
     def get_random_name(self, prefix):
         hex_length = int((15-len(prefix))/2)
         free = False
         while True:
             ifname = prefix + secrets.token_hex(hex_length)
-            if self.get_link(ifname=ifname) is None:
+            if self._find_link({'ifname': ifname}) is None:
                 return ifname
 
     def debug_dump(self):
@@ -241,6 +492,17 @@ class LinkRegistryItem():
         }
         self.state = link['state']
 
+        # veth peer link (netnsid is None if in the same netns)
+        self.peer_index = link.get_attr('IFLA_LINK')
+        self.peer_netnsid = link.get_attr('IFLA_LINK_NETNSID')
+
+        # alternative interface names (Linux 5.5+)
+        properties = link.get_attr('IFLA_PROP_LIST')
+        if properties is not None:
+            self.altnames = list(properties.get_attrs('IFLA_ALT_IFNAME'))
+        else:
+            self.altnames = []
+
         linkinfo = link.get_attr('IFLA_LINKINFO')
         if linkinfo and linkinfo.get_attr('IFLA_INFO_KIND') != None:
             self.attributes['kind'] = linkinfo.get_attr('IFLA_INFO_KIND')
@@ -274,7 +536,16 @@ class LinkRegistryItem():
 
         return True
 
+    def del_altname(self, altname):
+        self.__ipr_link('property_del', index=self.attributes['index'], altname=altname)
+
+        self.registry.unindex_altnames(self)
+        self.altnames.remove(altname)
+        self.registry.index_altnames(self)
+
     def update_ifname(self, ifname):
+        self.netns.sysctl.forget(self.attributes['ifname'])
+        self.netns.sysctl.forget(ifname)
         self.attributes['ifname'] = ifname
         self.__ipr_link('set', index=self.attributes['index'], state='down')
         self.__ipr_link('set', index=self.attributes['index'], ifname=ifname)
@@ -295,11 +566,20 @@ class LinkRegistryItem():
             if netns.netns is None:
                 self.netns.iw.set_wiphy_netns_by_pid(self.attributes['wiphy'], 1)
             else:
-                self.netns.iw.set_wiphy_netns_by_pid(self.attributes['wiphy'], netns.ipr.child)
+                netns_fd = os.open(netns_path(netns.netns), os.O_RDONLY)
+                try:
+                    self.netns.iw.set_wiphy_netns_by_fd(self.attributes['wiphy'], netns_fd)
+                finally:
+                    os.close(netns_fd)
         else:
             self.__ipr_link('set', index=self.attributes['index'], net_ns_fd=netns_name)
+        self.registry.unindex_altnames(self)
+        self.netns.sysctl.forget(self.attributes['ifname'])
         self.netns = netns
+        self.netns.sysctl.forget(self.attributes['ifname'])
+        self.registry.index_altnames(self)
         self.attributes['index'] = next(iter(self.netns.ipr.link_lookup(ifname=self.attributes['ifname'])), None)
+        self.netns.forget_dumps(self.attributes['index'])
 
     def __repr__(self):
         attributes = []
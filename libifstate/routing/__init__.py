@@ -326,18 +326,10 @@ class Tables(collections.abc.Mapping):
             kroutes = self.kernel_routes(table)
 
             for route in sorted(croutes, key=lambda x: [str(x.get('gateway', x.get('via', ''))), x['dst']]):
-                if 'oif' in route and type(route['oif']) == str:
-                    oif = next(
-                        iter(self.netns.ipr.link_lookup(ifname=route['oif'])), None)
-                    if oif is None:
-                        if 'gateway' in route:
-                            logger.log_warn(log_str, '! {}: dev {} is unknown'.format(route['dst'], route['oif']))
-                            del route['oif']
-                        else:
-                            logger.log_err(log_str, '! {}: dev {} is unknown'.format(route['dst'], route['oif']))
-                            continue
-                    else:
-                        route['oif'] = oif
+                route = self.resolve_route(log_str, route)
+                if route is None:
+                    continue
+
                 found = False
                 identical = False
                 matched = vrrp_match(route, by_vrrp, vrrp_type, vrrp_name, vrrp_state)
@@ -372,16 +364,7 @@ class Tables(collections.abc.Mapping):
                         else:
                             logger.log_add(log_str, "+ {}".format(route['dst']))
 
-                        logger.debug("ip route replace: {}".format(
-                            " ".join("{}={}".format(k, v) for k, v in route.items())))
-                        try:
-                            if do_apply:
-                                self.netns.ipr.route('replace', **route)
-                        except Exception as err:
-                            if not isinstance(err, netlinkerror_classes):
-                                raise
-                            logger.warning('route setup {} failed: {}'.format(
-                                route['dst'], err.args[1]))
+                        self.replace_route(route, do_apply)
 
             for route in kroutes:
                 ignore = False
@@ -393,14 +376,85 @@ class Tables(collections.abc.Mapping):
                     continue
 
                 logger.log_del(log_str, "- {}".format(route['dst']))
-                try:
-                    if do_apply:
-                        self.netns.ipr.route('del', **route)
-                except Exception as err:
-                    if not isinstance(err, netlinkerror_classes):
-                        raise
-                    logger.warning('removing route {} failed: {}'.format(
-                        route['dst'], err.args[1]))
+                self.del_route(route, do_apply)
+
+    def apply_vrrp(self, routes, do_apply):
+        '''
+        Apply the routes of a vrrp plan, a list of (table, route, enabled)
+        tuples. Only these routes are reconciled: enabled routes are
+        added and disabled routes are removed.
+        '''
+        kroutes = {}
+        for table, route, enabled in routes:
+            log_str = RTLookups.tables.lookup_str(table)
+            if self.netns.netns != None:
+                log_str += "[netns={}]".format(self.netns.netns)
+
+            route = self.resolve_route(log_str, route)
+            if route is None:
+                continue
+
+            # each table is dumped only once
+            if not table in kroutes:
+                kroutes[table] = self.kernel_routes(table)
+            kroute = next(
+                (kroute for kroute in kroutes[table] if route_matches(route, kroute)), None)
+
+            if not enabled:
+                if kroute is not None:
+                    logger.log_del(log_str, "- {}".format(route['dst']))
+                    self.del_route(kroute, do_apply)
+            elif kroute is None:
+                logger.log_add(log_str, "+ {}".format(route['dst']))
+                self.replace_route(route, do_apply)
+            elif route_matches(route, kroute, [key for key in route.keys() if key[0] != '_'], indent=route['dst']):
+                logger.log_ok(log_str, "= {}".format(route['dst']))
+            else:
+                logger.log_change(log_str, "~ {}".format(route['dst']))
+                self.replace_route(route, do_apply)
+
+    def resolve_route(self, log_str, route):
+        '''
+        Resolve the oif of a route on a copy, the configured route is
+        reused by later runs. Returns None if the route cannot be used.
+        '''
+        route = dict(route)
+        if 'oif' in route and type(route['oif']) == str:
+            oif = next(
+                iter(self.netns.ipr.link_lookup(ifname=route['oif'])), None)
+            if oif is None:
+                if 'gateway' in route:
+                    logger.log_warn(log_str, '! {}: dev {} is unknown'.format(route['dst'], route['oif']))
+                    del route['oif']
+                else:
+                    logger.log_err(log_str, '! {}: dev {} is unknown'.format(route['dst'], route['oif']))
+                    return None
+            else:
+                route['oif'] = oif
+
+        return route
+
+    def replace_route(self, route, do_apply):
+        logger.debug("ip route replace: {}".format(
+            " ".join("{}={}".format(k, v) for k, v in route.items())))
+        try:
+            if do_apply:
+                self.netns.ipr.route('replace', **route)
+        except Exception as err:
+            if not isinstance(err, netlinkerror_classes):
+                raise
+            logger.warning('route setup {} failed: {}'.format(
+                route['dst'], err.args[1]))
+
+    def del_route(self, route, do_apply):
+        try:
+            if do_apply:
+                self.netns.ipr.route('del', **route)
+        except Exception as err:
+            if not isinstance(err, netlinkerror_classes):
+                raise
+            logger.warning('removing route {} failed: {}'.format(
+                route['dst'], err.args[1]))
 
 
 class Rules():
@@ -558,16 +612,7 @@ class Rules():
                     logger.log_ok(log_str)
                 else:
                     logger.log_add(log_str)
-
-                    logger.debug("ip rule add: {}".format(
-                        " ".join("{}={}".format(k, v) for k, v in rule.items())))
-                    try:
-                        if do_apply:
-                            self.netns.ipr.rule('add', **rule)
-                    except Exception as err:
-                        if not isinstance(err, netlinkerror_classes):
-                            raise
-                        logger.warning('rule setup failed: {}'.format(err.args[1]))
+                    self.add_rule(rule, do_apply)
 
         for rule in krules:
             ignore = False
@@ -582,10 +627,53 @@ class Rules():
                 continue
 
             logger.log_del('#{}'.format(rule['priority']))
-            try:
-                if do_apply:
-                    self.netns.ipr.rule('del', **rule)
-            except Exception as err:
-                if not isinstance(err, netlinkerror_classes):
-                    raise
-                logger.warning('removing rule failed: {}'.format(err.args[1]))
+            self.del_rule(rule, do_apply)
+
+    def apply_vrrp(self, rules, do_apply):
+        '''
+        Apply the rules of a vrrp plan, a list of (rule, enabled) tuples.
+        Only these rules are reconciled: enabled rules are added and
+        disabled rules are removed.
+        '''
+        krules = self.kernel_rules()
+        for rule, enabled in rules:
+            log_str = '#{}'.format(rule['priority'])
+            if self.netns.netns != None:
+                log_str += "[netns={}]".format(self.netns.netns)
+
+            krule = next((krule for krule in krules if rule_matches(
+                rule,
+                krule,
+                # skip helper attrs like _vrrp
+                [key for key in rule.keys() if key[0] != '_']
+            )), None)
+
+            if not enabled:
+                if krule is not None:
+                    logger.log_del(log_str)
+                    self.del_rule(krule, do_apply)
+            elif krule is None:
+                logger.log_add(log_str)
+                self.add_rule(rule, do_apply)
+            else:
+                logger.log_ok(log_str)
+
+    def add_rule(self, rule, do_apply):
+        logger.debug("ip rule add: {}".format(
+            " ".join("{}={}".format(k, v) for k, v in rule.items())))
+        try:
+            if do_apply:
+                self.netns.ipr.rule('add', **rule)
+        except Exception as err:
+            if not isinstance(err, netlinkerror_classes):
+                raise
+            logger.warning('rule setup failed: {}'.format(err.args[1]))
+
+    def del_rule(self, rule, do_apply):
+        try:
+            if do_apply:
+                self.netns.ipr.rule('del', **rule)
+        except Exception as err:
+            if not isinstance(err, netlinkerror_classes):
+                raise
+            logger.warning('removing rule failed: {}'.format(err.args[1]))
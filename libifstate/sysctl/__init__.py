@@ -1,8 +1,18 @@
-from libifstate.util import logger, IfStateLogging
-import pyroute2.netns
+from libifstate.util import logger, IfStateLogging, netns_call
 
 import os
 
+# sysctl paths are resolved relative to this directory
+SYSCTL_NET = '/proc/sys/net'
+
+# families having per interface settings in conf/
+SYSCTL_FAMILIES = ('ipv4', 'ipv6')
+
+# settings derived from the link, not worth to be shown
+SYSCTL_SHOW_IGNORE = {
+    'ipv6': ('mtu',),
+}
+
 
 class Sysctl():
     def __init__(self, netns):
@@ -10,47 +20,168 @@ class Sysctl():
         self.globals = {}
         self.netns = netns
 
+        # family => iface => key => value
+        self.current = {}
+
     def add(self, iface, sysctl):
         self.sysctls[iface] = sysctl
 
     def add_global(self, proto, sysctl):
         self.globals[proto] = sysctl
 
-    def set_sysctl(self, iface_current, iface_config, family, key, val, do_apply):
-        if self.netns.netns is not None:
-            pyroute2.netns.pushns(self.netns.netns)
+    def batch(self, settings, do_apply):
+        '''
+        Reconcile a batch of sysctl settings [(iface_current, iface_config,
+        family, key, val), ...]. Settings found in the snapshot are
+        compared in memory. Otherwise the netns is entered only once per
+        batch and all settings are read (and written if changed) relative
+        to a single /proc/sys/net directory fd. Returns the list of changed
+        settings.
+        '''
+        def run(dir_fd):
+            return [setting for setting in settings if self.set_sysctl(dir_fd, *setting, do_apply)]
+
+        def run_dir_fd():
+            dir_fd = os.open(SYSCTL_NET, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                return run(dir_fd)
+            finally:
+                os.close(dir_fd)
+
+        if not settings:
+            return []
+
+        if not any(self.requires_io(*setting, do_apply) for setting in settings):
+            return run(None)
+
+        # /proc/sys/net is resolved against the netns of the calling thread
+        if self.netns.netns is None:
+            return run_dir_fd()
+        return netns_call(self.netns.netns, run_dir_fd)
+
+    def snapshot(self, ifaces=None, keys=None):
+        '''
+        Read the per interface ipv4/ipv6 sysctl settings in a single pass:
+        the conf/ directories are walked using os.scandir on directory fds
+        relative to a single /proc/sys/net directory fd. The interfaces and
+        the per family keys might be limited by ifaces and keys. Returns a
+        dict (family => iface => key => value).
+        '''
+        def read_iface(iface_fd, family):
+            values = {}
+            with os.scandir(iface_fd) as it:
+                for entry in it:
+                    if keys is not None and not entry.name in keys.get(family, ()):
+                        continue
+
+                    try:
+                        with open(os.open(entry.name, os.O_RDONLY, dir_fd=iface_fd)) as fh:
+                            values[entry.name] = fh.readline().rstrip()
+                    except OSError:
+                        # write-only or unsupported settings
+                        pass
+            return values
+
+        def run():
+            snapshot = {}
+            dir_fd = os.open(SYSCTL_NET, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                for family in SYSCTL_FAMILIES:
+                    snapshot[family] = {}
+                    try:
+                        conf_fd = os.open(os.path.join(family, 'conf'), os.O_RDONLY | os.O_DIRECTORY, dir_fd=dir_fd)
+                    except OSError:
+                        # family not available (i.e. ipv6 disabled)
+                        continue
 
+                    try:
+                        with os.scandir(conf_fd) as it:
+                            for entry in it:
+                                if ifaces is not None and not entry.name in ifaces:
+                                    continue
+
+                                iface_fd = os.open(entry.name, os.O_RDONLY | os.O_DIRECTORY, dir_fd=conf_fd)
+                                try:
+                                    snapshot[family][entry.name] = read_iface(iface_fd, family)
+                                finally:
+                                    os.close(iface_fd)
+                    finally:
+                        os.close(conf_fd)
+            finally:
+                os.close(dir_fd)
+
+            return snapshot
+
+        if self.netns.netns is None:
+            return run()
+        return netns_call(self.netns.netns, run)
+
+    def take_snapshot(self):
+        '''
+        Snapshot the current values of the configured per interface settings.
+        '''
+        if not self.sysctls:
+            return
+
+        keys = {}
+        for sysctl in self.sysctls.values():
+            for family, settings in sysctl.items():
+                keys.setdefault(family, set()).update(settings.keys())
+
+        self.current = self.snapshot(set(self.sysctls.keys()), keys)
+
+    def forget(self, iface):
+        '''
+        Drop the snapshot values of an interface, required if it has been
+        created, removed, renamed or moved.
+        '''
+        for values in self.current.values():
+            values.pop(iface, None)
+
+    def get_current(self, iface, family, key):
+        if iface is None:
+            return None
+        return self.current.get(family, {}).get(iface, {}).get(key)
+
+    def requires_io(self, iface_current, iface_config, family, key, val, do_apply):
+        current = self.get_current(iface_current, family, key)
+        return current is None or (do_apply and current != str(val))
+
+    def set_sysctl(self, dir_fd, iface_current, iface_config, family, key, val, do_apply):
         log_str = "{}/{}".format(family, key)
         if self.netns.netns is not None:
             log_str += "[netns={}]".format(self.netns.netns)
 
-        try:
-            fn = '/proc/sys/net/{}/conf/{}/{}'.format(family, iface_current, key)
+        if iface_current is None:
+            fn = os.path.join(family, key)
+        else:
+            fn = os.path.join(family, 'conf', iface_current, key)
+        current = self.get_current(iface_current, family, key)
+        if current is None:
             try:
-                with open(fn) as fh:
+                with open(os.open(fn, os.O_RDONLY, dir_fd=dir_fd)) as fh:
                     current = fh.readline().rstrip()
             except OSError as err:
                 logger.warning('reading sysctl {}/{} failed: {}'.format(
                     family, key, err.args[1]))
-                return
-            if current == str(val):
-                logger.debug('  %s/%s: %s == %s', family, key, current, val, extra={'iface': iface_config, 'netns': self.netns})
-                logger.log_ok(log_str)
                 return False
-            else:
-                logger.debug('  %s/%s: %s => %s', family, key, current, val, extra={'iface': iface_config, 'netns': self.netns})
-                if do_apply:
-                    try:
-                        with open(fn, 'w') as fh:
-                            fh.writelines([str(val)])
-                    except OSError as err:
-                        logger.warning('updating sysctl {}/{} failed: {}'.format(
-                            family, key, err.args[1]))
-                logger.log_change(log_str)
-                return True
-        finally:
-            if self.netns.netns is not None:
-                pyroute2.netns.popns()
+        if current == str(val):
+            logger.debug('  %s/%s: %s == %s', family, key, current, val, extra={'iface': iface_config, 'netns': self.netns})
+            logger.log_ok(log_str)
+            return False
+        else:
+            logger.debug('  %s/%s: %s => %s', family, key, current, val, extra={'iface': iface_config, 'netns': self.netns})
+            if do_apply:
+                try:
+                    with open(os.open(fn, os.O_WRONLY, dir_fd=dir_fd), 'w') as fh:
+                        fh.write(str(val))
+                    if self.get_current(iface_current, family, key) is not None:
+                        self.current[family][iface_current][key] = str(val)
+                except OSError as err:
+                    logger.warning('updating sysctl {}/{} failed: {}'.format(
+                        family, key, err.args[1]))
+            logger.log_change(log_str)
+            return True
 
     def apply(self, iface_current, do_apply, iface_config=None):
         # if None the interface has already the final name..
@@ -59,25 +190,42 @@ class Sysctl():
 
         if not iface_config in self.sysctls:
             logger.debug("no sysctl settings", extra={'iface': iface_config})
-            return
+            return False
 
         logger.debug('checking sysctl', extra={'iface': iface_config})
 
-        changes = False
-        for family in self.sysctls[iface_config].keys():
-            for key, val in self.sysctls[iface_config][family].items():
-                changes = changes or self.set_sysctl(iface_current, iface_config, family, key, val, do_apply)
+        return len(self.batch([
+            (iface_current, iface_config, family, key, val)
+            for family in self.sysctls[iface_config].keys()
+            for key, val in self.sysctls[iface_config][family].items()], do_apply)) > 0
+
+    @staticmethod
+    def show(snapshot, iface):
+        '''
+        Get the settings of an interface within a snapshot which differ
+        from the defaults (conf/default/).
+        '''
+        result = {}
+        for family, ifaces in snapshot.items():
+            defaults = ifaces.get('default', {})
+            settings = {}
+            for key, val in ifaces.get(iface, {}).items():
+                if key in defaults and defaults[key] != val and not key in SYSCTL_SHOW_IGNORE.get(family, ()):
+                    settings[key] = int(val) if val.lstrip('-').isdigit() else val
+            if settings:
+                result[family] = settings
+
+        return result
 
     def has_settings(self, iface):
         return iface in self.sysctls
 
     def apply_globals(self, do_apply):
-        changes = []
-        for proto, sysctl in self.globals.items():
-            for key, val in sysctl.items():
-                if self.set_sysctl('..', '..', proto, key, val, do_apply):
-                    changes.append(proto)
-        return changes
+        changes = self.batch([
+            (None, '..', proto, key, val)
+            for proto, sysctl in self.globals.items()
+            for key, val in sysctl.items()], do_apply)
+        return [proto for (_, _, proto, _, _) in changes]
 
     def has_globals(self):
         return len(self.globals) > 0
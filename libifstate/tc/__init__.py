@@ -1,8 +1,85 @@
-from libifstate.util import logger, IfStateLogging
+from libifstate.util import logger, IfStateLogging, NetnsDump
 from libifstate.exception import ExceptionCollector, netlinkerror_classes
 
 import errno
+import struct
+from socket import htons
 from pyroute2 import NetlinkError
+from pyroute2.netlink.rtnl.tcmsg.act_mirred import MIRRED_EACTIONS
+from pyroute2.netlink.rtnl.tcmsg.common import tc_actions
+
+# filter kinds which could be compared with the installed filters:
+#   kind => (action nla, {setting => option nla})
+TC_FILTER_OPTIONS = {
+    'basic': ('TCA_BASIC_ACT', {}),
+    'fw': ('TCA_FW_ACT', {}),
+    'matchall': ('TCA_MATCHALL_ACT', {'classid': 'TCA_MATCHALL_CLASSID'}),
+}
+
+# filter kinds having a configured handle (the fwmark of fw filters), it
+# is reported in the tcmsg header of the installed filter
+TC_FILTER_HANDLE_KINDS = ('fw',)
+
+# filter settings which are not part of the filter options
+TC_FILTER_SETTINGS = ('kind', 'prio', 'parent', 'protocol', 'action', 'index')
+
+# shared block attributes of qdiscs (not decoded by pyroute2)
+TC_BLOCK_NLAS = {
+    'TCA_INGRESS_BLOCK': 13,
+    'TCA_EGRESS_BLOCK': 14,
+}
+
+def get_tc_block(qdisc, nla):
+    '''
+    Get the shared block index of a qdisc or None if the qdisc is not
+    bound to a shared block.
+    '''
+    block = qdisc.get_attr(nla)
+    if block is not None:
+        return block
+
+    for attr in qdisc['attrs']:
+        if attr[0] == 'UNKNOWN' and attr[1]['header']['type'] == TC_BLOCK_NLAS[nla]:
+            return struct.unpack_from('I', attr[1].data, attr[1].offset + 4)[0]
+
+    return None
+
+class TCDump(NetnsDump):
+    '''
+    Qdiscs of a netns, indexed by ifindex and parent.
+    '''
+    def dump(self):
+        qdiscs = {}
+        for qdisc in self.netns.ipr.get_qdiscs():
+            qdiscs.setdefault(qdisc['index'], {})[qdisc['parent']] = qdisc
+        return qdiscs
+
+    def dump_link(self, idx):
+        return {qdisc['parent']: qdisc for qdisc in self.netns.ipr.get_qdiscs(index=idx)}
+
+    def get_filters(self, idx):
+        '''
+        Get the filters of the root and ingress qdiscs. The kernel dumps
+        filters only per link, the dumps are skipped if the link has
+        no qdisc which could hold filters.
+        '''
+        qdiscs = self.get(idx)
+
+        ipr_filters = []
+        if TC.ROOT_HANDLE in qdiscs:
+            ipr_filters.extend(self.netns.ipr.get_filters(index=idx))
+        if TC.INGRESS_PARENT in qdiscs:
+            ipr_filters.extend(self.netns.ipr.get_filters(index=idx, parent=TC.INGRESS_HANDLE))
+
+        return ipr_filters
+
+    def get_block_filters(self, block):
+        '''
+        Get the filters of a shared block, the kernel does not report
+        an error if the block does not exist (yet).
+        '''
+        return self.netns.ipr.get_filters(index=TC.BLOCK_INDEX, parent=block)
+
 
 class TC():
     ROOT_HANDLE = 0xFFFFFFFF
@@ -10,6 +87,8 @@ class TC():
     INGRESS_PARENT = 0xFFFFFFF1
     HMASK_MAJOR = 0xFFFF0000
     HMASK_MINOR = 0x0000FFFF
+    # TCM_IFINDEX_MAGIC_BLOCK (signed)
+    BLOCK_INDEX = -1
 
     def int2handle(h):
         maj = "{:x}".format((h & TC.HMASK_MAJOR) >> 16)
@@ -41,19 +120,40 @@ class TC():
         self.idx = None
         self.tc = tc
 
-    def get_qdisc(self, netns_qdiscs, parent):
-        for qdisc in netns_qdiscs:
-            if qdisc['parent'] == parent:
-                return qdisc
+    def get_qdisc(self, ipr_qdiscs, parent):
+        return ipr_qdiscs.get(parent)
 
-    def get_qchild(self, netns_qdiscs, parent, slot):
-        for qdisc in netns_qdiscs:
-            if qdisc['parent'] == parent | slot:
-                return qdisc
+    def get_qchild(self, ipr_qdiscs, parent, slot):
+        return ipr_qdiscs.get(parent | slot)
 
     def apply_ingress(self, ingress, qdisc, excpts, do_apply):
         logger.debug('checking ingress qdisc', extra={'iface': self.iface})
-        if not ingress:
+
+        # binding to an egress block requires the clsact qdisc
+        ingress_block = self.tc.get("ingress_block")
+        egress_block = self.tc.get("egress_block")
+        if egress_block is not None:
+            kind = "clsact"
+        else:
+            kind = "ingress"
+        ingress = ingress or ingress_block is not None or egress_block is not None
+
+        if qdisc:
+            blocks = (get_tc_block(qdisc, 'TCA_INGRESS_BLOCK'), get_tc_block(qdisc, 'TCA_EGRESS_BLOCK'))
+            logger.debug('  blocks: {} => {}'.format(
+                blocks, (ingress_block, egress_block)), extra={'iface': self.iface})
+
+            # an unbound qdisc is fine for plain ingress settings
+            if blocks != (ingress_block, egress_block):
+                recreate = True
+            elif ingress_block is not None or egress_block is not None:
+                recreate = qdisc.get_attr("TCA_KIND") != kind
+            else:
+                recreate = False
+        else:
+            recreate = False
+
+        if not ingress or recreate:
             if qdisc:
                 if do_apply:
                     opts = {
@@ -68,23 +168,28 @@ class TC():
                         logger.warning('removing ingress qdisc on {} failed: {}'.format(
                             self.iface, err.args[1]))
                         excpts.add('del', err, **opts)
-                return True
-        else:
-            if not qdisc:
-                if do_apply:
-                    opts = {
-                        "index": self.idx,
-                        "kind": "ingress",
-                    }
-                    try:
+            if not ingress:
+                return bool(qdisc)
+
+        if not qdisc or recreate:
+            if do_apply:
+                opts = {
+                    "index": self.idx,
+                    "kind": kind,
+                }
+                try:
+                    if ingress_block is None and egress_block is None:
                         self.netns.ipr.tc("add", **opts)
-                    except Exception as err:
-                        if not isinstance(err, netlinkerror_classes):
-                            raise
-                        logger.warning('adding ingress qdisc on {} failed: {}'.format(
-                            self.iface, err.args[1]))
-                        excpts.add('add', err, **opts)
-                return True
+                    else:
+                        self.netns.ipr.add_block_qdisc(
+                            ingress_block=ingress_block, egress_block=egress_block, **opts)
+                except Exception as err:
+                    if not isinstance(err, netlinkerror_classes):
+                        raise
+                    logger.warning('adding {} qdisc on {} failed: {}'.format(
+                        kind, self.iface, err.args[1]))
+                    excpts.add('add', err, **opts)
+            return True
 
         return False
 
@@ -158,13 +263,130 @@ class TC():
 
         changes = recreate
         if "children" in tc:
+            handle = TC.handle2int(tc["handle"])
             for i in range(len(tc["children"])):
-                changes = changes or self.apply_qtree(tc["children"][i], self.get_qchild(
-                    ipr_qdiscs, qdisc["handle"], i+1), ipr_qdiscs, TC.handle2int(tc["handle"]) | i + 1, do_apply, recreate)
+                changes = self.apply_qtree(tc["children"][i], self.get_qchild(
+                    ipr_qdiscs, handle, i+1), ipr_qdiscs, handle | i + 1, excpts, do_apply, recreate) or changes
 
         return changes
 
-    def apply_filter(self, tc, ipr_filters, excpts, do_apply):
+    def normalize_actions(self, actions):
+        '''
+        Normalize the configured filter actions, returns None if they
+        cannot be compared with installed actions.
+        '''
+        result = []
+        for action in actions:
+            if action.get("kind") != "mirred" or action.get("ifindex") is None:
+                return None
+
+            result.append((
+                "mirred",
+                MIRRED_EACTIONS[(action["direction"], action["action"])],
+                action["ifindex"],
+                tc_actions["stolen"] if action["action"] == "redirect" else tc_actions["pipe"],
+                action.get("index"),
+            ))
+
+        return tuple(result)
+
+    def normalize_ipr_actions(self, ipr_actions, actions):
+        '''
+        Normalize the installed filter actions (TCA_ACT_PRIO_*). The action
+        index is only compared if it is configured.
+        '''
+        if ipr_actions is None:
+            return ()
+
+        result = []
+        for i, (_, ipr_action) in enumerate(sorted(ipr_actions['attrs'], key=lambda attr: int(attr[0].rsplit('_', 1)[1]))):
+            if ipr_action.get_attr('TCA_ACT_KIND') != 'mirred':
+                return None
+
+            parms = ipr_action.get_attr('TCA_ACT_OPTIONS').get_attr('TCA_MIRRED_PARMS')
+            if i < len(actions) and actions[i].get("index") is not None:
+                index = parms['index']
+            else:
+                index = None
+            result.append(("mirred", parms['eaction'], parms['ifindex'], parms['action'], index))
+
+        return tuple(result)
+
+    def normalize_filter(self, tc_filter):
+        '''
+        Normalize a configured filter, returns None if it cannot be
+        compared with installed filters.
+        '''
+        kind = tc_filter["kind"]
+        if not kind in TC_FILTER_OPTIONS:
+            return None
+
+        protocol = tc_filter.get("protocol", 3)
+        if not isinstance(protocol, int):
+            return None
+
+        options = {}
+        for k, v in tc_filter.items():
+            if k in TC_FILTER_OPTIONS[kind][1]:
+                options[k] = TC.handle2int(v) if k == "classid" else v
+            elif k == "handle" and kind in TC_FILTER_HANDLE_KINDS:
+                options[k] = v
+            elif not k in TC_FILTER_SETTINGS:
+                # settings like ematches are not decoded
+                return None
+
+        actions = self.normalize_actions(tc_filter.get("action", []))
+        if actions is None:
+            return None
+
+        return (kind, htons(protocol & 0xFFFF), tuple(sorted(options.items())), actions)
+
+    def normalize_ipr_filter(self, ipr_filters, tc_filter):
+        '''
+        Normalize the installed filter of a prio. The kernel dumps a
+        header entry per prio followed by the entries having options.
+        '''
+        entries = [ipr_filter for ipr_filter in ipr_filters if ipr_filter.get_attr("TCA_OPTIONS") is not None]
+        if len(entries) != 1:
+            return None
+
+        ipr_filter = entries[0]
+        kind = ipr_filter.get_attr("TCA_KIND")
+        if not kind in TC_FILTER_OPTIONS:
+            return None
+
+        (act_nla, option_nlas) = TC_FILTER_OPTIONS[kind]
+        ipr_options = ipr_filter.get_attr("TCA_OPTIONS")
+        options = {}
+        for k, nla in option_nlas.items():
+            v = ipr_options.get_attr(nla)
+            if v is not None:
+                options[k] = v
+
+        if kind in TC_FILTER_HANDLE_KINDS:
+            options["handle"] = ipr_filter["handle"]
+
+        actions = self.normalize_ipr_actions(ipr_options.get_attr(act_nla), tc_filter.get("action", []))
+        if actions is None:
+            return None
+
+        return (kind, ipr_filter["info"] & 0xFFFF, tuple(sorted(options.items())), actions)
+
+    def get_root_handle(self, ipr_qdiscs):
+        '''
+        Filters without parent are attached to the root qdisc, the
+        kernel reports the handle of the root qdisc as their parent.
+        '''
+        if self.tc.get("qdisc"):
+            return TC.handle2int(self.tc["qdisc"]["handle"])
+        elif TC.ROOT_HANDLE in ipr_qdiscs:
+            return ipr_qdiscs[TC.ROOT_HANDLE]["handle"]
+        else:
+            return 0
+
+    def apply_filter(self, tc, ipr_filters, ipr_qdiscs, excpts, do_apply):
+        root_handle = self.get_root_handle(ipr_qdiscs)
+
         tc_filters = {}
         # assign prio numbers if missing
         for i in range(len(tc)):
@@ -172,30 +394,32 @@ class TC():
                 tc[i]["prio"] = 0xc001 - len(tc) + i
 
             parent = TC.handle2int(tc[i].get("parent", 0))
+            if parent == 0:
+                parent = root_handle
             if not parent in tc_filters:
                 tc_filters[parent] = {}
 
             tc_filters[parent][tc[i]["prio"]] = tc[i]
 
-        changes = False
-        # remove unreferenced filters
-        removed = {}
+        # installed filters: parent => prio => [filter entries]
+        installed = {}
         for ipr_filter in ipr_filters:
             prio = ipr_filter["info"] >> 16
-
             parent = TC.handle2int(ipr_filter.get("parent", 0))
-            rm = not parent in tc_filters
-            rm |= parent in tc_filters and \
-                prio not in tc_filters[parent]
-            if rm and prio not in removed.get(parent, []):
+            installed.setdefault(parent, {}).setdefault(prio, []).append(ipr_filter)
+
+        changes = False
+        # remove unreferenced filters
+        for parent, prios in installed.items():
+            for prio, entries in prios.items():
+                if prio in tc_filters.get(parent, {}):
+                    continue
+
                 changes = True
-                if not parent in removed:
-                    removed[parent] = []
-                removed[parent].append(prio)
                 if do_apply:
                     opts = {
                         "index": self.idx,
-                        "info": ipr_filter["info"],
+                        "info": entries[0]["info"],
                         "parent": parent,
                     }
                     try:
@@ -207,49 +431,56 @@ class TC():
                             prio, self.iface, err.args[1]))
                         excpts.add('del', err, **opts)
 
-        if do_apply:
-            for parent in tc_filters.keys():
-                for tc_filter in tc_filters[parent].values():
-                    tc_filter['index'] = self.idx
-                    if "action" in tc_filter:
-                        for action in tc_filter["action"]:
-                            if action["kind"] == "mirred":
-                                # get ifindex
-                                action["ifindex"] = next(
-                                    iter(self.netns.ipr.link_lookup(ifname=action["dev"])), None)
-
-                                if self.idx == None:
-                                    logger.warning("filter #{} references unknown interface {}".format(
-                                        tc_filter["prio"], action["dev"]), extra={'iface': self.iface})
-                                    continue
-                    if "parent" in tc_filter:
-                        tc_filter["parent"] = TC.handle2int(tc_filter["parent"])
-                    try:
-                        try:
-                            self.netns.ipr.tc("replace-filter", **tc_filter)
-                            # replace seems only to work if there is no filter
-                            # => something has changed
-                            changes = True
-                        except Exception as err:
-                            if not isinstance(err, netlinkerror_classes):
-                                raise
-                            # replace does not work, supress changes result
-                            # for now
-                            #changes = True
-                            opts = {
-                                "index": self.idx,
-                                "info": tc_filter["prio"] << 16,
-                                "parent": parent,
-                            }
-                            self.netns.ipr.del_filter_by_info(**opts)
-                            self.netns.ipr.tc("add-filter", **tc_filter)
+        for parent in tc_filters.keys():
+            for tc_filter in tc_filters[parent].values():
+                tc_filter['index'] = self.idx
+                if "action" in tc_filter:
+                    for action in tc_filter["action"]:
+                        if action["kind"] == "mirred":
+                            # get ifindex
+                            action["ifindex"] = next(
+                                iter(self.netns.ipr.link_lookup(ifname=action["dev"])), None)
+
+                            if action["ifindex"] == None:
+                                logger.warning("filter #{} references unknown interface {}".format(
+                                    tc_filter["prio"], action["dev"]), extra={'iface': self.iface})
+                if "parent" in tc_filter:
+                    tc_filter["parent"] = TC.handle2int(tc_filter["parent"])
+
+                # skip filters matching the installed filter
+                entries = installed.get(parent, {}).get(tc_filter["prio"], [])
+                normalized = self.normalize_filter(tc_filter)
+                if entries and normalized is not None:
+                    ipr_normalized = self.normalize_ipr_filter(entries, tc_filter)
+                    logger.debug('  filter #{}: {} => {}'.format(
+                        tc_filter["prio"], ipr_normalized, normalized), extra={'iface': self.iface})
+                    if ipr_normalized == normalized:
+                        continue
+
+                changes = True
+                if not do_apply:
+                    continue
 
+                try:
+                    try:
+                        self.netns.ipr.tc("replace-filter", **tc_filter)
                     except Exception as err:
                         if not isinstance(err, netlinkerror_classes):
                             raise
-                        logger.warning('replace filter #{} on {} failed: {}'.format(
-                            tc_filter['prio'], self.iface, err.args[1]))
-                        excpts.add('replace', err, **tc_filter)
+                        # replace does not work for every classifier
+                        opts = {
+                            "index": self.idx,
+                            "info": tc_filter["prio"] << 16,
+                            "parent": parent,
+                        }
+                        self.netns.ipr.del_filter_by_info(**opts)
+                        self.netns.ipr.tc("add-filter", **tc_filter)
+                except Exception as err:
+                    if not isinstance(err, netlinkerror_classes):
+                        raise
+                    logger.warning('replace filter #{} on {} failed: {}'.format(
+                        tc_filter['prio'], self.iface, err.args[1]))
+                    excpts.add('replace', err, **tc_filter)
 
         return changes
 
@@ -264,12 +495,11 @@ class TC():
             return
 
         changes = []
-        ipr_qdiscs = None
+        ipr_qdiscs = self.netns.tc_dump.get(self.idx)
 
         # apply ingress qdics
-        if "ingress" in self.tc:
-            ipr_qdiscs = self.netns.ipr.get_qdiscs(index=self.idx)
-            if self.apply_ingress(self.tc["ingress"],
+        if "ingress" in self.tc or "ingress_block" in self.tc or "egress_block" in self.tc:
+            if self.apply_ingress(self.tc.get("ingress", False),
                                   self.get_qdisc(
                                       ipr_qdiscs, TC.INGRESS_PARENT),
                                   excpts,
@@ -278,8 +508,6 @@ class TC():
 
         # apply qdisc tree
         if "qdisc" in self.tc:
-            if ipr_qdiscs is None:
-                ipr_qdiscs = self.netns.ipr.get_qdiscs(index=self.idx)
             logger.debug('checking qdisc tree', extra={'iface': self.iface})
             if self.apply_qtree(
                     self.tc["qdisc"],
@@ -292,12 +520,12 @@ class TC():
 
         # apply filters
         if "filter" in self.tc:
-            ipr_filters = self.netns.ipr.get_filters(
-                index=self.idx) + self.netns.ipr.get_filters(index=self.idx, parent=TC.INGRESS_HANDLE)
+            ipr_filters = self.netns.tc_dump.get_filters(self.idx)
             logger.debug('checking filters', extra={'iface': self.iface})
             if self.apply_filter(
                     self.tc["filter"],
                     ipr_filters,
+                    ipr_qdiscs,
                     excpts,
                     do_apply):
                 changes.append("filter")
@@ -308,3 +536,37 @@ class TC():
             logger.log_ok('tc')
 
         return excpts
+
+
+class TCBlock(TC):
+    '''
+    Filters of a shared block. The kernel creates the block when the
+    first qdisc is bound to it, the filters apply to all bound links.
+    '''
+    def __init__(self, netns, block, tc):
+        super().__init__(netns, "block {}".format(block), tc)
+        self.block = block
+
+        for tc_filter in self.tc.get("filter", []):
+            tc_filter["parent"] = block
+
+    def get_root_handle(self, ipr_qdiscs):
+        return self.block
+
+    def apply(self, do_apply):
+        excpts = ExceptionCollector(ifname=self.iface)
+        self.idx = TC.BLOCK_INDEX
+
+        ipr_filters = self.netns.tc_dump.get_block_filters(self.block)
+        logger.debug('checking filters', extra={'iface': self.iface})
+        if self.apply_filter(
+                self.tc.get("filter", []),
+                ipr_filters,
+                {},
+                excpts,
+                do_apply):
+            logger.log_change('tc', 'change (filter)')
+        else:
+            logger.log_ok('tc')
+
+        return excpts
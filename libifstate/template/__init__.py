@@ -0,0 +1,65 @@
+from libifstate.util import logger
+
+
+class InterfaceTemplate():
+    '''
+    Expands a single interface template over a range of indices. The
+    instances are built lazily and share all settings which do not
+    depend on the index with the template.
+    '''
+    def __init__(self, template):
+        self.interface = template['interface']
+        self.index_attrs = template.get('index_attrs', [])
+        self.range = range(
+            template['range']['start'],
+            template['range']['stop'] + 1,
+            template['range'].get('step', 1))
+
+        # lookup the settings requiring formatting only once
+        self.link_fmt = [attr for attr, value in self.interface['link'].items()
+                         if isinstance(value, str) and '{' in value]
+        self.addresses_fmt = any(
+            '{' in address for address in self.interface.get('addresses', []))
+
+        logger.debug('template %s: %d instances', self.interface['name'], len(self),
+                     extra={'iface': self.interface['name']})
+
+    def __len__(self):
+        return len(self.range)
+
+    def __iter__(self):
+        for index in self.range:
+            yield self.instance(index)
+
+    def first(self):
+        '''
+        Returns the first instance of the template, used to validate the
+        template against the interface schema.
+        '''
+        return self.instance(self.range.start)
+
+    def last(self):
+        '''
+        Returns the last instance of the template. Together with first()
+        it covers the bounds of the index values and the longest name.
+        '''
+        return self.instance(self.range[-1])
+
+    def instance(self, index):
+        # shallow copy: unchanged settings are shared between all instances
+        ifstate = dict(self.interface)
+        ifstate['name'] = self.interface['name'].format(index)
+
+        if self.link_fmt or self.index_attrs:
+            link = dict(self.interface['link'])
+            for attr in self.link_fmt:
+                link[attr] = link[attr].format(index)
+            for attr in self.index_attrs:
+                link[attr] = index
+            ifstate['link'] = link
+
+        if self.addresses_fmt:
+            ifstate['addresses'] = [address.format(index)
+                                    for address in self.interface['addresses']]
+
+        return ifstate
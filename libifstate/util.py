@@ -3,12 +3,13 @@ from libifstate.log import logger, IfStateLogging
 from pyroute2 import IPRoute, IW, NetNS, netns
 
 from pyroute2.netlink.rtnl.tcmsg import tcmsg
-from pyroute2.netlink.rtnl import RTM_DELTFILTER, RTM_NEWNSID
+from pyroute2.netlink.rtnl import RTM_DELTFILTER, RTM_NEWNSID, RTM_NEWQDISC
 from pyroute2.netlink.rtnl.nsidmsg import nsidmsg
-from pyroute2.netlink import NLM_F_REQUEST
+from pyroute2.netlink import nlmsg, NLM_F_REQUEST
 from pyroute2.netlink import NLM_F_ACK
 from pyroute2.netlink import NLM_F_CREATE
 from pyroute2.netlink import NLM_F_EXCL
+from pyroute2.netlink import NETLINK_GENERIC, NETLINK_ROUTE
 
 try:
     # pyroute2 <0.6
@@ -24,6 +25,7 @@ import struct
 import array
 import struct
 import typing
+import threading
 import os
 
 # ethtool helper
@@ -48,8 +50,80 @@ L2_ADDRLENGTH = 6  # L2 address length
 
 REGEX_ETHER_BYTE = re.compile('[a-f0-9]{2}')
 
+# max. number of netlink requests sent at once by IPRouteExt.request_batch
+NETLINK_BATCH_SIZE = 512
+
 root_ipr = typing.NewType("IPRouteExt", IPRoute)
 
+def netns_path(netns_name):
+    '''
+    Get the nsfs path of a named netns or the root netns (if None).
+    '''
+    if netns_name is None:
+        return '/proc/1/ns/net'
+
+    return os.path.join(netns.NETNS_RUN_DIR, netns_name)
+
+def netns_call(netns_name, func, *args, create=True, **kwargs):
+    '''
+    Call func in a short-lived thread which has joined the named netns
+    using setns(2). Sockets created by func stay bound to the netns after
+    the thread has terminated, so no proxy process is required. A missing
+    netns is created unless create is False.
+    '''
+    result = {}
+
+    def run():
+        try:
+            if netns_name is None:
+                netns.setns(netns_path(netns_name), flags=0)
+            elif create:
+                # missing namespaces are created (like NetNS does)
+                netns.setns(netns_name, flags=os.O_CREAT)
+            else:
+                netns.setns(netns_name, flags=0)
+            result['value'] = func(*args, **kwargs)
+        except Exception as ex:
+            result['error'] = ex
+
+    thread = threading.Thread(target=run, name="netns-{}".format(netns_name))
+    thread.start()
+    thread.join()
+
+    if 'error' in result:
+        raise result['error']
+
+    return result['value']
+
+def netns_sockets(netns_name, create=True):
+    '''
+    Open the netlink (rtnl + generic) and ioctl sockets inside of the
+    named netns. The sockets are handed to IPRouteExt and IW using their
+    fileno argument, which works regardless of whether pyroute2 binds its
+    sockets at construction or per thread.
+    '''
+    def open_sockets():
+        return (
+            socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_ROUTE),
+            socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_GENERIC),
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM),
+        )
+
+    return netns_call(netns_name, open_sockets, create=create)
+
+def netns_iproute(netns_name, create=True):
+    '''
+    Open a new IPRouteExt instance inside the named netns (or the root
+    netns if None). Worker threads need their own instance: pyroute2 may
+    bind the socket of an IPRoute instance to the thread using it and
+    closes it when that thread terminates.
+    '''
+    if netns_name is None:
+        return IPRouteExt()
+
+    (rtnl_sock, _, ioctl_sock) = netns_sockets(netns_name, create)
+    return IPRouteExt(fileno=rtnl_sock.detach(), ioctl_sock=ioctl_sock)
+
 def filter_ifla_dump(showall, ifla, defaults, prefix="IFLA"):
     dump = {}
 
@@ -75,11 +149,41 @@ def format_ether_address(address):
 
     return ':'.join(REGEX_ETHER_BYTE.findall(address.lower()))
 
+class tcmsg_block(nlmsg):
+    '''
+    tcmsg with the shared block attributes, which are not known by
+    pyroute2's tcmsg (yet). No subclass of tcmsg since pyroute2 caches
+    the compiled nla_map per class hierarchy.
+    '''
+    prefix = 'TCA_'
+    fields = tcmsg.fields
+    nla_map = (
+        ('TCA_UNSPEC', 'none'),
+        ('TCA_KIND', 'asciiz'),
+        ('TCA_OPTIONS', 'hex'),
+        ('TCA_STATS', 'hex'),
+        ('TCA_XSTATS', 'hex'),
+        ('TCA_RATE', 'hex'),
+        ('TCA_FCNT', 'hex'),
+        ('TCA_STATS2', 'hex'),
+        ('TCA_STAB', 'hex'),
+        ('TCA_PAD', 'hex'),
+        ('TCA_DUMP_INVISIBLE', 'flag'),
+        ('TCA_CHAIN', 'uint32'),
+        ('TCA_HW_OFFLOAD', 'uint8'),
+        ('TCA_INGRESS_BLOCK', 'uint32'),
+        ('TCA_EGRESS_BLOCK', 'uint32'),
+    )
+
+
 class IPRouteExt(IPRoute):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, ioctl_sock=None, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if ioctl_sock is None:
+            self.__sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self.__sock = ioctl_sock
 
 
 
@@ -113,6 +217,52 @@ class IPRouteExt(IPRoute):
             NLM_F_ACK
         ))
 
+    def add_block_qdisc(self, index, kind, ingress_block=None, egress_block=None):
+        '''
+        Add an ingress or clsact qdisc bound to shared filter blocks.
+        '''
+        msg = tcmsg_block()
+        msg['index'] = index
+        msg['handle'] = 0xFFFF0000
+        msg['parent'] = 0xFFFFFFF1
+        msg['attrs'].append(('TCA_KIND', kind))
+        if ingress_block is not None:
+            msg['attrs'].append(('TCA_INGRESS_BLOCK', ingress_block))
+        if egress_block is not None:
+            msg['attrs'].append(('TCA_EGRESS_BLOCK', egress_block))
+
+        return tuple(self.nlm_request(
+            msg,
+            msg_type=RTM_NEWQDISC,
+            msg_flags=NLM_F_REQUEST |
+            NLM_F_ACK |
+            NLM_F_CREATE |
+            NLM_F_EXCL
+        ))
+
+    def request_batch(self, msgs, what, extra=None):
+        '''
+        Send requests (with prepared netlink headers) in batches, each
+        batch is sent by a single sendmsg. The kernel processes all
+        requests of a batch. Returns False if any request has failed: the
+        batch does not report which requests failed, the caller needs to
+        check the resulting state of the objects (what).
+        '''
+        failed = 0
+        try:
+            for i in range(0, len(msgs), NETLINK_BATCH_SIZE):
+                batch = msgs[i:i + NETLINK_BATCH_SIZE]
+                acks = sum(1 for msg in self.nlm_request_batch(batch, noraise=True)
+                           if msg['header'].get('error') is None)
+                failed += len(batch) - acks
+        except Exception as err:
+            if not isinstance(err, libifstate.exception.netlinkerror_classes):
+                raise
+            logger.warning('updating {} failed: {}'.format(what, err.args[1]), extra=extra)
+            return False
+
+        return failed == 0
+
     def get_businfo(self, ifname):
         data = array.array("B", struct.pack(
             "I", ETHTOOL_GDRVINFO))
@@ -336,6 +486,53 @@ class NetNSExt(NetNS):
 
         return None
 
+class NetnsDump():
+    '''
+    Netlink objects of a netns grouped by ifindex, dumped at once on the
+    first lookup and shared by all users within the netns. Subclasses
+    implement the dump of the netns and of a single link.
+    '''
+    def __init__(self, netns):
+        self.netns = netns
+        # ifindex => objects
+        self.entries = None
+        # ifindex of links changed after the dump
+        self.stale = set()
+
+    def dump(self):
+        '''
+        Dump the objects of all links, returns a dict (ifindex => objects).
+        '''
+        raise NotImplementedError()
+
+    def dump_link(self, idx):
+        '''
+        Dump the objects of a single link.
+        '''
+        raise NotImplementedError()
+
+    def get(self, idx):
+        if self.entries is None:
+            self.entries = self.dump()
+            self.stale = set()
+
+        if idx in self.stale:
+            self.stale.remove(idx)
+            self.entries[idx] = self.dump_link(idx)
+
+        return self.entries.get(idx, {})
+
+    def reset(self):
+        self.entries = None
+
+    def forget(self, idx):
+        '''
+        Refresh the objects of a link on the next lookup, required if it
+        has been created, moved or changed after the dump.
+        '''
+        if self.entries is not None:
+            self.stale.add(idx)
+
 class LinkDependency:
     def __init__(self, ifname, netns):
         self.ifname = ifname
@@ -0,0 +1,110 @@
+from libifstate.util import logger
+
+import hashlib
+import json
+
+# states reported by keepalived
+VRRP_STATES = ('unknown', 'fault', 'backup', 'master', 'stop')
+
+
+class VrrpPlan():
+    '''
+    Precompiled actions of a single vrrp transition (type, name, state).
+    The links, routes and rules affected by the vrrp group/instance are
+    fully determined by the config, so a transition only reconciles
+    these objects.
+    '''
+    def __init__(self, ifstate, stages, vrrp_type, vrrp_name, vrrp_state):
+        self.vrrp_type = vrrp_type
+        self.vrrp_name = vrrp_name
+        self.vrrp_state = vrrp_state
+
+        # [[(netns, link_dep), ...], ...] - links per stage in order of dependencies
+        self.stages = []
+        # [(netns, [(table, route, enabled), ...]), ...]
+        self.routes = []
+        # [(netns, [(rule, enabled), ...]), ...]
+        self.rules = []
+
+        for stage in stages:
+            links = []
+            for link_dep in stage:
+                netns = ifstate.get_netns(link_dep.netns)
+                if netns is None:
+                    continue
+
+                link = netns.links.get(link_dep.ifname)
+                if link is not None and link.match_vrrp_select(vrrp_type, vrrp_name):
+                    links.append((netns, link_dep))
+
+            if links:
+                self.stages.append(links)
+
+        for netns in ifstate.get_namespaces():
+            if netns.tables is not None:
+                routes = [
+                    (table, route, vrrp_state in route['_vrrp']['states'])
+                    for table, croutes in netns.tables.tables.items()
+                    for route in croutes
+                    if self.match(route)]
+                if routes:
+                    self.routes.append((netns, routes))
+
+            if netns.rules is not None:
+                rules = [
+                    (rule, vrrp_state in rule['_vrrp']['states'])
+                    for rule in netns.rules.rules
+                    if self.match(rule)]
+                if rules:
+                    self.rules.append((netns, rules))
+
+        logger.debug('vrrp plan %s: %d link stages, %d route and %d rule namespaces',
+                     vrrp_state, len(self.stages), len(self.routes), len(self.rules),
+                     extra={'iface': '{} "{}"'.format(vrrp_type, vrrp_name)})
+
+    def links(self):
+        '''
+        Get the config links reconciled by the plan.
+        '''
+        return [netns.links[link_dep.ifname] for stage in self.stages for (netns, link_dep) in stage]
+
+    def match(self, obj):
+        return '_vrrp' in obj and obj['_vrrp']['type'] == self.vrrp_type and obj['_vrrp']['name'] == self.vrrp_name
+
+
+def vrrp_fingerprints(ifstates):
+    '''
+    Get a fingerprint of the config sections of each vrrp group/instance
+    (interfaces, interface templates, routes and rules having a vrrp
+    setting). The global parameters are part of all fingerprints. Used to
+    detect which vrrp groups/instances are affected by a config change.
+    '''
+    sections = {}
+
+    def add(key, netns_name, kind, obj):
+        sections.setdefault(key, []).append((netns_name, kind, obj))
+
+    netns_ifstates = [(None, ifstates)]
+    netns_ifstates.extend(ifstates.get('namespaces', {}).items())
+    for netns_name, netns_ifstate in netns_ifstates:
+        for ifstate in netns_ifstate.get('interfaces', []):
+            if 'vrrp' in ifstate:
+                add((ifstate['vrrp']['type'], ifstate['vrrp']['name']), netns_name, 'interface', ifstate)
+
+        for template in netns_ifstate.get('interface_templates', []):
+            if 'vrrp' in template['interface']:
+                vrrp = template['interface']['vrrp']
+                add((vrrp['type'], vrrp['name']), netns_name, 'template', template)
+
+        for kind in ['routes', 'rules']:
+            for obj in netns_ifstate.get('routing', {}).get(kind, []):
+                if 'vrrp' in obj:
+                    add((obj['vrrp']['type'], obj['vrrp']['name']), netns_name, kind, obj)
+
+    parameters = ifstates.get('parameters', {})
+    fingerprints = {}
+    for key, objs in sections.items():
+        fingerprints[key] = hashlib.sha256(json.dumps(
+            [parameters, objs], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    return fingerprints